@@ -1,55 +1,84 @@
 import asyncio
-import json
 import itertools
 import math
+import multiprocessing
 import os
+import pickle
 import tempfile
 import time
 import uuid
 import nanome
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from nanome.api.structure import Complex, Molecule
-from nanome.api.shapes import Label, Shape, Anchor
 from nanome.api.interactions import Interaction
-from nanome.util import async_callback, enums, Logs, Process, Vector3, ComplexUtils
+from nanome.util import async_callback, enums, Logs, Process, ComplexUtils
 from typing import List
 
 from . import utils
 from .forms import LineSettingsForm
 from .menus import ChemInteractionsMenu, SettingsMenu
-from .models import InteractionStructure
-from .managers import InteractionLineManager, LabelManager, ShapesLineManager
-from .utils import interaction_type_map
-from .clean_pdb import clean_pdb
+from .models import AtomNotFoundException, AtomPathIndex, AtomTable, InteractionStructure
+from .managers import InteractionLineManager, LabelManager, LineIndex, LineUploader, ShapesLineManager
+from .clean_pdb import CleanedPdbCache
+from .contacts import ContactsReader, ContactsTable, InteractionKindTable, parse_contact_specs
 
 
-PDBOPTIONS = Complex.io.PDBSaveOptions()
-PDBOPTIONS.write_bonds = True
-
 # By default Arpeggio times out after 10 minutes (600 seconds)
 ARPEGGIO_TIMEOUT = int(os.environ.get('ARPEGGIO_TIMEOUT', 0) or 600)
 
+# Number of cleaned pdb files kept in the temp dir, so unchanged structures aren't cleaned again.
+CLEAN_PDB_CACHE_SIZE = int(os.environ.get('CLEAN_PDB_CACHE_SIZE', 0) or 8)
+
+# Number of worker processes used to parse Arpeggio contacts.
+# By default (0) contacts are parsed in threads within the plugin process.
+PARSE_PROCESS_COUNT = int(os.environ.get('PARSE_PROCESS_COUNT', 0) or 0)
+
+# Number of contacts read from arpeggio output at a time, before being parsed into lines.
+CONTACTS_BATCH_SIZE = 10000
 
-class AtomNotFoundException(Exception):
-    pass
+# Number of lines sent to Nanome per upload message, while contacts are still being parsed.
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 0) or 5000)
+
+# Maximum number of upload messages awaiting acknowledgement before parsing waits for them.
+MAX_PENDING_UPLOADS = 4
+
+# Share of the loading bar taken by each stage of the calculation.
+PROGRESS_STAGE_WEIGHTS = {'clean': 1, 'parse': 4, 'upload': 1}
 
 
 class ChemicalInteractions(nanome.AsyncPluginInstance):
 
     def start(self):
         self.temp_dir = tempfile.TemporaryDirectory()
+        self.clean_pdb_cache = CleanedPdbCache(self.temp_dir.name, CLEAN_PDB_CACHE_SIZE)
         self.residue = ''
         self.menu = ChemInteractionsMenu(self)
         self.settings_menu = SettingsMenu(self)
         self.show_distance_labels = False
         self.integration.run_interactions = self.start_integration
         self.line_manager = self.get_line_manager()
+        self.progress = utils.ProgressTracker(self.menu.update_loading_bar)
         self.currently_running_recalculate = False
         self.recalculate_queue = []
+        self.parse_executor = None
 
     def on_stop(self):
+        if self.parse_executor:
+            self.parse_executor.shutdown(cancel_futures=True)
         self.temp_dir.cleanup()
 
+    def get_parse_executor(self, process_count):
+        """Return pool of worker processes used to parse contacts, started on first use.
+
+        The pool is shared by every calculation, so workers are only started once.
+        Workers are started by a forkserver, rather than forking this process and its running threads.
+        """
+        if self.parse_executor is None:
+            self.parse_executor = ProcessPoolExecutor(
+                max_workers=process_count, mp_context=multiprocessing.get_context('forkserver'))
+        return self.parse_executor
+
     @async_callback
     async def on_run(self):
         complexes = await self.request_complex_list()
@@ -63,6 +92,8 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
 
     @async_callback
     async def on_complex_list_changed(self):
+        # Interactions may have been added or removed along with complexes.
+        self.line_manager.invalidate()
         complexes = await self.request_complex_list()
         for comp in complexes:
             comp.register_complex_updated_callback(self.on_complex_updated)
@@ -163,6 +194,7 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
         extra = {"atom_selection_mode": selection_mode}
         Logs.message(f'Selection Mode = {selection_mode}', extra=extra)
         start_time = time.time()
+        self.progress.reset(PROGRESS_STAGE_WEIGHTS)
 
         # Let's make sure we have a deep target complex and ligand complexes
         ligand_complexes = set()
@@ -205,47 +237,64 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
 
         # make the request to get interactions
         self.menu.set_update_text("Calculating...")
-        contacts_data = await self.run_arpeggio_process(data, cleaned_filepath)
-        if contacts_data is None:
-            message = 'Arpeggio run failed'
-            Logs.warning(message)
-            self.send_notification(enums.NotificationTypes.error, message)
-            return
-        Logs.message(f'Contacts Count: {len(contacts_data)}')
-
-        interacting_entities_to_render = settings['interacting_entities']
-        contacts_per_thread = 1000
-        thread_count = max(len(contacts_data) // contacts_per_thread, 1)
-        futs = []
-        self.total_contacts_count = len(contacts_data)
-        self.loading_bar_i = 0
+        with tempfile.TemporaryDirectory(dir=self.temp_dir.name) as output_dir:
+            contacts_filepath = await self.run_arpeggio(data, cleaned_filepath, output_dir)
+            if contacts_filepath is None:
+                message = 'Arpeggio run failed'
+                Logs.warning(message)
+                self.send_notification(enums.NotificationTypes.error, message)
+                return
 
-        relevant_mol_indices = [cmp.current_molecule.index for cmp in complexes if cmp.current_molecule]
-        all_lines_at_start = await self.line_manager.all_lines(molecules_idx=relevant_mol_indices)
-        new_lines = []
-        # Set up ThreadPoolExecutor to parse contacts data into InteractionLines.
-        if contacts_data:
-            with ThreadPoolExecutor(max_workers=thread_count) as executor:
-                for chunk in utils.chunks(contacts_data, len(contacts_data) // thread_count):
-                    fut = executor.submit(
-                        self.parse_contacts_data,
-                        chunk, complexes, line_settings, selected_atoms_only,
-                        interacting_entities_to_render, all_lines_at_start)
-                    futs.append(fut)
-            for fut in futs:
-                new_lines += fut.result()
-        Logs.debug(f"{self.loading_bar_i} / {self.total_contacts_count} contacts processed")
+            interacting_entities_to_render = settings['interacting_entities']
+
+            relevant_mol_indices = [cmp.current_molecule.index for cmp in complexes if cmp.current_molecule]
+            all_lines_at_start = await self.line_manager.all_lines(molecules_idx=relevant_mol_indices)
+            # Index existing lines once, so checking for duplicates is a single lookup.
+            # Existing lines found again while parsing are kept, rather than being drawn again.
+            existing_line_index = LineIndex(all_lines_at_start)
+
+            # Contacts are read in batches, and each batch is parsed into lines as soon as it is read.
+            contacts_batches = self.iter_contacts_batches(contacts_filepath)
+            # Build atom lookup and interaction kind table once, and share them across workers.
+            atom_index = AtomPathIndex(complexes)
+            kind_table = InteractionKindTable(LineSettingsForm(data=line_settings).data)
+            if PARSE_PROCESS_COUNT > 0:
+                line_chunks = self.iter_lines_in_processes(
+                    contacts_batches, selected_atoms_only, interacting_entities_to_render,
+                    existing_line_index, atom_index, kind_table, PARSE_PROCESS_COUNT)
+            else:
+                line_chunks = self.iter_lines_in_threads(
+                    contacts_batches, complexes, line_settings, selected_atoms_only,
+                    interacting_entities_to_render, existing_line_index, atom_index, kind_table)
+
+            # Parse in a background thread, and upload each chunk of lines while the next one is parsed.
+            uploader = LineUploader(
+                self.line_manager, UPLOAD_CHUNK_SIZE, MAX_PENDING_UPLOADS, complexes, self.progress)
+            loop = asyncio.get_event_loop()
+            while True:
+                lines = await loop.run_in_executor(None, next, line_chunks, None)
+                if lines is None:
+                    break
+                await uploader.add(lines)
+            await uploader.flush()
+            new_lines = uploader.uploaded_lines
+        Logs.message(f"Contacts Count: {self.progress.stage_totals['parse']}")
+        Logs.debug(f"{self.progress.stage_counts['parse']} / {self.progress.stage_totals['parse']} contacts processed")
         Logs.debug("Finished parsing contacts data")
 
-        # Destroy existing lines between two structures in the current frame
-        # This ensures we remove any interactions that are no longer present
+        # Destroy existing lines in the current frame that weren't found again,
+        # and make sure the visibility of the ones we kept matches the line settings.
         existing_lines_in_frame = utils.get_lines_in_frame(all_lines_at_start, complexes)
-        if existing_lines_in_frame:
-            self.line_manager.destroy_lines(existing_lines_in_frame)
-
-        # Re-Upload all lines
-        self.line_manager.upload(new_lines)
-        self.line_manager.add_lines(new_lines)
+        vanished_lines = existing_line_index.unmatched_lines(existing_lines_in_frame)
+        if vanished_lines:
+            self.line_manager.destroy_lines(vanished_lines)
+        kept_lines = existing_line_index.matched_lines()
+        changed_lines = self.line_manager.update_visibility(kept_lines, line_settings)
+        Logs.debug(
+            f"{len(new_lines)} lines added, {len(vanished_lines)} removed, "
+            f"{len(kept_lines)} kept ({len(changed_lines)} updated)")
+        self.progress.complete('upload')
+        all_lines = kept_lines + new_lines
 
         # Make sure complexes are locked
         comps_to_lock = [cmp for cmp in complexes if not cmp.locked]
@@ -257,7 +306,7 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
             self.update_structures_shallow(comps_to_lock)
 
         if distance_labels:
-            await self.render_distance_labels(complexes, new_lines)
+            await self.render_distance_labels(complexes, all_lines)
 
         async def log_elapsed_time(start_time):
             """Log the elapsed time since start time.
@@ -270,28 +319,18 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
             Logs.message(msg, extra={'calculation_time': float(elapsed_time)})
 
         asyncio.create_task(log_elapsed_time(start_time))
-        notification_txt = f"Finished Calculating Interactions! {len(new_lines)} interactions found."
+        notification_txt = f"Finished Calculating Interactions! {len(all_lines)} interactions found."
         asyncio.create_task(self.send_async_notification(notification_txt))
 
     def get_clean_pdb_file(self, complex):
         """Clean complex to prep for arpeggio."""
         Logs.debug("Cleaning complex for arpeggio")
-        complex_file = tempfile.NamedTemporaryFile(suffix='.pdb', delete=False, dir=self.temp_dir.name)
-        complex.io.to_pdb(complex_file.name, PDBOPTIONS)
-
-        cleaned_filepath = clean_pdb(complex_file.name, self)
+        # Cleaned pdb is written straight from the Complex, and reused while the structure is unchanged.
+        cleaned_filepath = self.clean_pdb_cache.clean_complex(complex, progress=self.progress)
         if os.path.getsize(cleaned_filepath) / 1000 == 0:
             message = 'Complex file is empty, unable to clean =(.'
             Logs.error(message)
             raise Exception(message)
-        if not os.path.exists(cleaned_filepath):
-            # If clean_pdb fails, just try sending the uncleaned
-            # complex to arpeggio
-            # Not sure how effective that is, but :shrug:
-            Logs.warning('Clean Complex failed. Sending uncleaned file to arpeggio.')
-            cleaned_filepath = complex_file.name
-        else:
-            complex_file.close()
         return cleaned_filepath
 
     @staticmethod
@@ -376,87 +415,46 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
 
         rtype: nanome.api.Atom object, or None
         """
-        chain_name, res_id, atom_name = atom_path.split('/')
-        # Use the molecule corresponding to current frame
-        comp_mol = comp.current_molecule
-        if not comp_mol:
-            return
-        # Chain naming seems inconsistent, so we need to check the provided name,
-        # as well as heteroatom variation
-        atoms = [
-            a for a in comp_mol.atoms
-            if all([
-                a.name == atom_name,
-                str(a.residue.serial) == str(res_id),
-                a.chain.name in [chain_name, f'H{chain_name}']
-            ])
-        ]
-        if not atoms:
-            return
-
-        if len(atoms) > 1:
-            # If multiple atoms found, check exact matches (no heteroatoms)
-            atoms = [
-                a for a in comp_mol.atoms
-                if all([
-                    a.name == atom_name,
-                    str(a.residue.serial) == str(res_id),
-                    a.chain.name == chain_name
-                ])
-            ]
-            if not atoms:
-                msg = f"Error finding atom {atom_path}. Please ensure atoms are uniquely named."
-                Logs.warning(msg)
-                raise AtomNotFoundException(msg)
-
-            if len(atoms) > 1:
-                # Just pick the first one? :grimace:
-                Logs.debug(f'Too many Atoms found for {atom_path}')
-                atoms = atoms[:1]
-        atom = atoms[0]
-        return atom
+        return AtomPathIndex([comp]).get_atom(atom_path)
 
     @classmethod
-    def parse_ring_atoms(cls, atom_path, complexes):
+    def parse_ring_atoms(cls, atom_path, complexes, atom_index=None):
         """Parse aromatic ring path into a list of Atoms.
 
         e.g 'C/100/C1,C2,C3,C4,C5,C6' --> C/100/C1, C/100/C2, C/100/C3, etc
         :rtype: List of Atoms.
         """
+        atom_index = atom_index or AtomPathIndex(complexes)
         chain_name, res_id, atom_names = atom_path.split('/')
         atom_names = atom_names.split(',')
         atom_paths = [f'{chain_name}/{res_id}/{atomname}' for atomname in atom_names]
 
         atoms = []
         for atompath in atom_paths:
-            atom = None
-            for comp in complexes:
-                atom = cls.get_atom_from_path(comp, atompath)
-                if atom:
-                    break
+            atom = atom_index.get_atom(atompath)
             if atom:
                 atoms.append(atom)
         return atoms
 
     @classmethod
-    def parse_atoms_from_atompaths(cls, atom_paths, complexes):
+    def parse_atoms_from_atompaths(cls, atom_paths, complexes, atom_index=None):
         """Return a list of atoms from the complexes based on the atom_paths.
 
+        atom_index: AtomPathIndex built from complexes. Created if not provided.
         :rtype: List of Atoms
         """
+        atom_index = atom_index or AtomPathIndex(complexes)
         struct_list = []
         for atompath in atom_paths:
-            atom = None
             if ',' in atompath:
                 # Parse aromatic ring, and add list of atoms to struct_list
-                ring_atoms = cls.parse_ring_atoms(atompath, complexes)
+                ring_atoms = cls.parse_ring_atoms(atompath, complexes, atom_index)
+                if not ring_atoms:
+                    continue
                 struct = InteractionStructure(ring_atoms)
             else:
                 # Parse single atom
-                for comp in complexes:
-                    atom = cls.get_atom_from_path(comp, atompath)
-                    if atom:
-                        break
+                atom = atom_index.get_atom(atompath)
                 if not atom:
                     continue
                 struct = InteractionStructure(atom)
@@ -465,74 +463,54 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
 
     def parse_contacts_data(
             self, contacts_data, complexes, line_settings, selected_atoms_only=False,
-            interacting_entities=None, existing_lines=None):
+            interacting_entities=None, existing_lines=None, atom_index=None, kind_table=None):
         """Parse .contacts file into list of Lines to be rendered in Nanome.
 
         contacts_data: Data returned by Chemical Interaction Service.
         complexes: strucutre.Complex objects that can contain atoms in contacts_data.
         line_settings: dict. Data to populate LineSettingsForm.
         interaction_data. LineSettingsForm data describing color and visibility of interactions.
+        atom_index: AtomPathIndex built from complexes. Created if not provided.
+        kind_table: InteractionKindTable compiled from line_settings. Created if not provided.
 
         :rtype: LineManager object containing new lines to be uploaded to Nanome workspace.
         """
         interacting_entities = interacting_entities or ['INTER', 'INTRA_SELECTION', 'SELECTION_WATER']
-        existing_lines = existing_lines or []
+        if not isinstance(existing_lines, LineIndex):
+            existing_lines = LineIndex(existing_lines)
+        atom_index = atom_index or AtomPathIndex(complexes)
         form = LineSettingsForm(data=line_settings)
         form.validate()
         if form.errors:
             raise Exception(form.errors)
-        # Set variables used to track loading bar progress across threads.
-        if not hasattr(self, 'loading_bar_i'):
-            self.loading_bar_i = 0
-        if not hasattr(self, 'total_contacts_count'):
-            self.total_contacts_count = len(contacts_data)
+        kind_table = kind_table or InteractionKindTable(form.data)
+
+        if not isinstance(contacts_data, ContactsTable):
+            contacts_data = ContactsTable.from_rows(contacts_data)
+
+        # Filter out rows we can't render before resolving any structures.
+        # If we dont have line settings for any of the interactions in the row, it is dropped.
+        # Typically this filters out rows with only `proximal` interactions.
+        # Also drop rows where the structure's relationship is not included
+        row_count = len(contacts_data)
+        contacts_data = contacts_data.renderable_rows(kind_table.accepted_mask, interacting_entities)
 
         new_lines = []
         self.menu.set_update_text("Updating Workspace...")
-        # Update loading bar every 5% of contacts completed
-        update_percentages = list(range(100, 0, -5))
-        for row in contacts_data:
-            self.loading_bar_i += 1
-            current_percentage = math.ceil((self.loading_bar_i / self.total_contacts_count) * 100)
-            if update_percentages and current_percentage > update_percentages[-1]:
-                Logs.debug(f"{self.loading_bar_i} / {self.total_contacts_count} contacts processed")
-                self.menu.update_loading_bar(self.loading_bar_i, self.total_contacts_count)
-                update_percentages.pop()
+        for atom1_path, atom2_path, contact_mask in contacts_data.iter_rows():
+            # Switch arpeggio contact types into nanome InteractionKind enums and their line settings
+            interaction_kinds = kind_table.get_kinds(contact_mask)
 
             # Atom paths that current row is describing interactions between
-            a1_data = row['bgn']
-            a2_data = row['end']
-            arpegg_contact_types = row['contact']
-            # Switch arpeggio contact type string into nanome InteractionKind enum
-            try:
-                interaction_kinds = [
-                    interaction_type_map[contact_type].name
-                    for contact_type in arpegg_contact_types
-                    if contact_type in interaction_type_map.keys()
-                ]
-            except KeyError:
-                pass
-
-            # If we dont have line settings for any of the interactions in the row, we can continue
-            # Typically this filters out rows with only `proximal` interactions.
-            if not set(interaction_kinds).intersection(set(form.data.keys())):
-                continue
-
-            # If structure's relationship is not included, continue
-            if row['interacting_entities'] not in interacting_entities:
-                continue
-
-            atom1_path = f"{a1_data['auth_asym_id']}/{a1_data['auth_seq_id']}/{a1_data['auth_atom_id']}"
-            atom2_path = f"{a2_data['auth_asym_id']}/{a2_data['auth_seq_id']}/{a2_data['auth_atom_id']}"
             atom_paths = [atom1_path, atom2_path]
 
             # A struct can be either an atom or a list of atoms, indicating an aromatic ring.
             try:
-                struct_list = self.parse_atoms_from_atompaths(atom_paths, complexes)
+                struct_list = self.parse_atoms_from_atompaths(atom_paths, complexes, atom_index)
             except AtomNotFoundException:
                 message = (
                     f"Failed to parse interactions between {atom1_path} and {atom2_path} "
-                    f"skipping {len(arpegg_contact_types)} interactions"
+                    f"skipping {len(interaction_kinds)} interactions"
                 )
                 Logs.warning(message)
                 continue
@@ -549,70 +527,143 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
                 continue
 
             for struct in struct_list:
-                # Set `frame` and `conformer` attribute for InteractionStructure.
-                for comp in complexes:
-                    atom_indices = [a.index for a in struct.atoms]
-
-                    current_mol = getattr(comp, 'current_molecule', Molecule())
-                    relevant_atoms = [
-                        a.index for a in current_mol.atoms
-                        if a.index in atom_indices
-                    ]
-                    if relevant_atoms:
-                        struct.frame = comp.current_frame
-                        struct.conformer = comp.current_conformer
+                # Set `frame` and `conformer` attribute for InteractionStructure,
+                # based on the complex containing its atoms.
+                owner = atom_index.atom_owners.get(struct.line_anchor.index)
+                if owner:
+                    _, struct.frame, struct.conformer = owner
             # Create new lines and save them in memory
             struct1, struct2 = struct_list
-            structpair_lines = self.create_new_lines(struct1, struct2, interaction_kinds, form.data, existing_lines)
+            structpair_lines = self.create_new_lines(struct1, struct2, interaction_kinds, existing_lines)
             new_lines += structpair_lines
+        # Progress is reported once per batch, rather than once per row.
+        self.progress.advance('parse', row_count)
         return new_lines
 
-    def create_new_lines(self, struct1, struct2, interaction_kinds, line_settings, existing_lines=None):
+    def iter_contacts_batches(self, contacts_filepath):
+        """Yield ContactsTables read incrementally from arpeggio output file.
+
+        The total for the 'parse' progress stage is kept up to date with an estimate
+        based on how much of the file has been read.
+        """
+        reader = ContactsReader(contacts_filepath, CONTACTS_BATCH_SIZE)
+        for contacts_data in reader:
+            self.progress.set_total('parse', reader.estimated_row_count)
+            yield contacts_data
+        self.progress.set_total('parse', reader.rows_read)
+
+    def iter_lines_in_threads(
+            self, contacts_batches, complexes, line_settings, selected_atoms_only,
+            interacting_entities, existing_lines, atom_index, kind_table):
+        """Parse batches of contacts into Lines, splitting each batch across a ThreadPoolExecutor.
+
+        Yields the list of new Lines for each batch, to be uploaded to Nanome workspace.
+        """
+        contacts_per_thread = 1000
+        for contacts_data in contacts_batches:
+            thread_count = max(len(contacts_data) // contacts_per_thread, 1)
+            futs = []
+            with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                for chunk in utils.chunks(contacts_data, len(contacts_data) // thread_count):
+                    fut = executor.submit(
+                        self.parse_contacts_data,
+                        chunk, complexes, line_settings, selected_atoms_only,
+                        interacting_entities, existing_lines, atom_index, kind_table)
+                    futs.append(fut)
+            new_lines = []
+            for fut in futs:
+                new_lines += fut.result()
+            yield new_lines
+
+    def iter_lines_in_processes(
+            self, contacts_batches, selected_atoms_only, interacting_entities, existing_lines,
+            atom_index, kind_table, process_count):
+        """Parse batches of contacts into Lines, resolving atom paths in a pool of worker processes.
+
+        Workers receive a picklable AtomTable rather than Complexes, written to a file once per run,
+        and return compact line specs, which are turned into Lines here as each chunk completes. Finished chunks are yielded
+        while later batches are still being read, with a bounded number of chunks in flight.
+
+        contacts_batches: ContactsTable, or iterable of ContactsTables.
+        Yields the list of new Lines for each chunk, to be uploaded to Nanome workspace.
+        """
+        if isinstance(contacts_batches, ContactsTable):
+            contacts_batches = [contacts_batches]
+        if not isinstance(existing_lines, LineIndex):
+            existing_lines = LineIndex(existing_lines)
+        self.menu.set_update_text("Updating Workspace...")
+        contacts_per_chunk = 1000
+        max_pending_chunks = process_count * 4
+        pending_chunks = deque()
+
+        def collect_next_chunk():
+            chunk_size, fut = pending_chunks.popleft()
+            specs, skipped_rows = fut.result()
+            for atom1_path, atom2_path, mask in skipped_rows:
+                message = (
+                    f"Failed to parse interactions between {atom1_path} and {atom2_path} "
+                    f"skipping {len(kind_table.get_kinds(mask))} interactions"
+                )
+                Logs.warning(message)
+            self.progress.advance('parse', chunk_size)
+            return self.create_lines_from_specs(specs, atom_index, kind_table, existing_lines)
+
+        executor = self.get_parse_executor(process_count)
+        atom_table_path = os.path.join(self.temp_dir.name, f'atom_table_{uuid.uuid4()}.pickle')
+        with open(atom_table_path, 'wb') as f:
+            pickle.dump(AtomTable(atom_index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            for contacts_data in contacts_batches:
+                row_count = len(contacts_data)
+                contacts_data = contacts_data.renderable_rows(kind_table.accepted_mask, interacting_entities)
+                self.progress.advance('parse', row_count - len(contacts_data))
+                for chunk in utils.chunks(contacts_data, contacts_per_chunk):
+                    fut = executor.submit(parse_contact_specs, chunk.compact(), atom_table_path, selected_atoms_only)
+                    pending_chunks.append((len(chunk), fut))
+                # Create lines from finished chunks in order, before reading the next batch.
+                while pending_chunks and (len(pending_chunks) > max_pending_chunks or pending_chunks[0][1].done()):
+                    yield collect_next_chunk()
+            while pending_chunks:
+                yield collect_next_chunk()
+        finally:
+            # The pool is shared, so don't leave work from a failed run queued behind the next one.
+            for _, fut in pending_chunks:
+                fut.cancel()
+            os.remove(atom_table_path)
+
+    def create_lines_from_specs(self, specs, atom_index, kind_table, existing_lines=None):
+        """Turn line specs returned by parse_contact_specs into Lines."""
+        new_lines = []
+        atoms_by_index = atom_index.atoms_by_index
+        for mask, struct1_indices, struct1_frame, struct1_conformer, struct2_indices, struct2_frame, struct2_conformer in specs:
+            struct1 = InteractionStructure([atoms_by_index[i] for i in struct1_indices])
+            struct2 = InteractionStructure([atoms_by_index[i] for i in struct2_indices])
+            struct1.frame = struct1_frame
+            struct1.conformer = struct1_conformer
+            struct2.frame = struct2_frame
+            struct2.conformer = struct2_conformer
+            interaction_kinds = kind_table.get_kinds(mask)
+            new_lines += self.create_new_lines(struct1, struct2, interaction_kinds, existing_lines)
+        return new_lines
+
+    def create_new_lines(self, struct1, struct2, interaction_kinds, existing_lines=None):
         """Parse rows of data from .contacts file into Line objects.
 
         struct1: InteractionStructure
         struct2: InteractionStructure
-        interaction_types: list of interaction types that exist between struct1 and struct2
-        line_settings: Color and shape information for each type of Interaction.
+        interaction_kinds: list of (InteractionKind, line settings) tuples for the interactions between struct1 and struct2.
+            Line settings contain color and shape information for that type of Interaction.
+        existing_lines: LineIndex (or list) of lines already in the workspace, which won't be drawn again.
         """
-        existing_lines = existing_lines or []
+        if not isinstance(existing_lines, LineIndex):
+            existing_lines = LineIndex(existing_lines)
         new_lines = []
-        for interaction_kind_str in interaction_kinds:
-            interaction_kind = enums.InteractionKind[interaction_kind_str]
-            form_data = line_settings.get(interaction_kind_str)
-            if not form_data:
-                continue
-
+        for interaction_kind, form_data in interaction_kinds:
             # See if we've already drawn this line
-            line_exists = False
-            try:
-                structpair_lines = self.line_manager.get_lines_for_structure_pair(
-                    struct1, struct2, existing_lines)
-            except AttributeError:
-                continue
-
-            struct1_atom_index = int(struct1.index)
-            for lin in structpair_lines:
-                struct1_is_atom1 = struct1_atom_index in lin.atom1_idx_arr
-                if struct1_is_atom1:
-                    struct1_conformer_in_frame = struct1.conformer == lin.atom1_conformation
-                    struct2_conformer_in_frame = struct2.conformer == lin.atom2_conformation
-                else:
-                    struct1_conformer_in_frame = struct1.conformer == lin.atom2_conformation
-                    struct2_conformer_in_frame = struct2.conformer == lin.atom1_conformation
-                if all([
-                    struct1_conformer_in_frame,
-                    struct2_conformer_in_frame,
-                        lin.kind == interaction_kind]):
-                    line_exists = True
-                    break
-            if line_exists:
+            line_key = LineIndex.get_structpair_key(struct1, struct2, interaction_kind)
+            if existing_lines.match(line_key):
                 continue
 
-            if interaction_kind == enums.InteractionKind.All:
-                # Not sure how we're getting in a situation where we have an interaction kind of 'All'
-                Logs.debug('Interaction Kind is All, skipping')
-                continue
             # Draw line and add data about interaction type and frames.
             line = self.line_manager.draw_interaction_line(struct1, struct2, interaction_kind, form_data)
             new_lines.append(line)
@@ -640,8 +691,8 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
         self.send_notification(notification_type, message)
 
     async def render_distance_labels(self, complexes=None, lines=None):
+        """Show distance labels for visible lines, only updating labels that changed since the last render."""
         Logs.message('Rendering Distance Labels')
-        self.label_manager.clear()
         if not complexes:
             ws = await self.request_workspace()
             complexes = ws.complexes
@@ -653,30 +704,18 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
             ]
             all_lines = await self.line_manager.all_lines(molecules_idx=molecule_indices)
             lines = utils.get_lines_in_frame(all_lines, complexes)
-        for line in lines:
-            # If theres any visible lines between the two structs in structpair, add a label.
+        # If theres any visible lines between the two structs in structpair, add a label.
+        visible_lines = [line for line in lines if line.visible]
+        distances = utils.calculate_interaction_lengths(visible_lines, complexes).tolist()
+        desired_labels = []
+        for line, interaction_distance in zip(visible_lines, distances):
+            if math.isnan(interaction_distance):
+                continue
             struct1_index = int(line.atom1_idx_arr[0])
             struct2_index = int(line.atom2_idx_arr[0])
-            if line.visible:
-                label = Label()
-                interaction_distance = utils.calculate_interaction_length(line, complexes)
-                label.text = str(round(interaction_distance, 2))
-                label.font_size = 0.06
-                anchor1 = Anchor()
-                anchor2 = Anchor()
-                anchor1.target = struct1_index
-                anchor2.target = struct2_index
-                anchor1.anchor_type = enums.ShapeAnchorType.Atom
-                anchor2.anchor_type = enums.ShapeAnchorType.Atom
-                viewer_offset = Vector3(0, 0, -.01)
-                anchor1.viewer_offset = viewer_offset
-                anchor2.viewer_offset = viewer_offset
-                label.anchors = [anchor1, anchor2]
-                self.label_manager.add_label(label, struct1_index, struct2_index)
-        label_count = len(self.label_manager.all_labels())
-        if label_count > 0:
-            await Shape.upload_multiple(self.label_manager.all_labels())
-            Logs.message(f'Uploaded {label_count} distance labels')
+            desired_labels.append((struct1_index, struct2_index, str(round(interaction_distance, 2))))
+        added, removed, updated = await self.label_manager.reconcile(desired_labels)
+        Logs.message(f'Distance labels: {len(added)} uploaded, {len(removed)} deleted, {len(updated)} updated')
 
     def clear_distance_labels(self):
         self.show_distance_labels = False
@@ -684,9 +723,21 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
         self.label_manager.clear()
         Logs.message(f'Deleted {label_count} distance labels')
 
+    @classmethod
+    async def run_arpeggio_process(cls, data, input_filepath):
+        """Run arpeggio, and load all contacts from its output into a ContactsTable."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_filepath = await cls.run_arpeggio(data, input_filepath, temp_dir)
+            if output_filepath is None:
+                return
+            return ContactsTable.from_file(output_filepath)
+
     @staticmethod
-    async def run_arpeggio_process(data, input_filepath):
-        output_data = {}
+    async def run_arpeggio(data, input_filepath, temp_dir):
+        """Run arpeggio, writing output into temp_dir.
+
+        rtype: str, path to arpeggio's json output file. None if the run failed.
+        """
         # Set up and run arpeggio command
         exe_path = 'conda'
         arpeggio_path = 'arpeggio'
@@ -703,25 +754,22 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
 
         # Create directory for output
         temp_uuid = uuid.uuid4()
-        with tempfile.TemporaryDirectory() as temp_dir:
-            output_dir = f'{temp_dir}/{temp_uuid}'
-            args.extend(['-o', output_dir])
+        output_dir = f'{temp_dir}/{temp_uuid}'
+        args.extend(['-o', output_dir])
 
-            p = Process(exe_path, args, True, label="arpeggio", timeout=ARPEGGIO_TIMEOUT)
-            p.on_error = Logs.warning
-            p.on_output = Logs.message
-            exit_code = await p.start()
-            Logs.message(f'Arpeggio Exit code: {exit_code}')
+        p = Process(exe_path, args, True, label="arpeggio", timeout=ARPEGGIO_TIMEOUT)
+        p.on_error = Logs.warning
+        p.on_output = Logs.message
+        exit_code = await p.start()
+        Logs.message(f'Arpeggio Exit code: {exit_code}')
 
-            if not os.path.exists(output_dir) or not os.listdir(output_dir):
-                Logs.error('Arpeggio run failed.')
-                return
+        if not os.path.exists(output_dir) or not os.listdir(output_dir):
+            Logs.error('Arpeggio run failed.')
+            return
 
-            output_filename = next(fname for fname in os.listdir(output_dir))
-            output_filepath = f'{output_dir}/{output_filename}'
-            with open(output_filepath, 'r') as f:
-                output_data = json.load(f)
-            return output_data
+        output_filename = next(fname for fname in os.listdir(output_dir))
+        output_filepath = f'{output_dir}/{output_filename}'
+        return output_filepath
 
     def setup_previous_run(
         self, target_complex: Complex, ligand_residues: list, ligand_complexes: list, line_settings: dict,
@@ -741,7 +789,8 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
         # Get all updated complexes
         Logs.debug('Starting complex updated callback')
         start_time = time.time()
-        self.label_manager.clear()
+        if not self.show_distance_labels:
+            self.label_manager.clear()
 
         ws = await self.request_workspace()
         updated_comp_list = ws.complexes
@@ -857,10 +906,15 @@ class ChemicalInteractions(nanome.AsyncPluginInstance):
                 break
         return comp_changed
 
-    async def update_interaction_lines(self, interactions_data, complexes=None):
+    async def update_interaction_lines(self, interactions_data, complexes=None, kinds=None):
+        """Update lines according to interactions_data.
+
+        kinds: list of InteractionKinds whose settings changed. By default all lines are updated.
+        """
         complexes = complexes or []
         await self._ensure_deep_complexes(complexes)
-        await self.line_manager.update_interaction_lines(interactions_data, complexes=complexes, plugin=self)
+        await self.line_manager.update_interaction_lines(
+            interactions_data, complexes=complexes, plugin=self, kinds=kinds)
         if self.show_distance_labels:
             # Refresh label manager
             await self.render_distance_labels(complexes)
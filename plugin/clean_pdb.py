@@ -20,25 +20,43 @@
 
 # IMPORTS
 import argparse
+import hashlib
 import logging
-import math
 import operator
 import os
 import sys
 import traceback
 from functools import reduce
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+from Bio.Data.IUPACData import atom_weights
 from Bio.PDB import PDBParser
-from Bio.PDB.Polypeptide import PPBuilder
+from Bio.PDB.Polypeptide import PPBuilder, is_aa
 
 
 # CONSTANTS
-PDB_LINE_TEMPLATE = '{record: <6}{serial: >5} {atom_name: ^4}{altloc: ^1}{resname: ^3} {chain_id: ^1}{resnum: >4}{icode: ^1}   {x: >8.3f}{y: >8.3f}{z: >8.3f}{occ: >6.2f}{tfac: >6.2f}          {element: >2}{charge: >2}'
+# Number of residues cleaned per task.
+RESIDUE_BATCH_SIZE = 1000
 
+# Max distance between C and N atoms of consecutive residues in a polypeptide, as used by PPBuilder.
+PEPTIDE_BOND_RADIUS = 1.8
 
-def clean_pdb(pdb_path, plugin_instance=None, remove_waters=False, keep_hydrogens=True, informative_filenames=False):
+# Lines are split around the coordinates, so cleaned structures can be rewritten with new coordinates.
+PDB_LINE_PREFIX_TEMPLATE = '{record: <6}{serial: >5} {atom_name: ^4}{altloc: ^1}{resname: ^3} {chain_id: ^1}{resnum: >4}{icode: ^1}   '
+PDB_COORDINATES_TEMPLATE = '{x: >8.3f}{y: >8.3f}{z: >8.3f}'
+PDB_LINE_SUFFIX_TEMPLATE = '{occ: >6.2f}{tfac: >6.2f}          {element: >2}{charge: >2}'
+PDB_LINE_TEMPLATE = PDB_LINE_PREFIX_TEMPLATE + PDB_COORDINATES_TEMPLATE + PDB_LINE_SUFFIX_TEMPLATE
+
+
+def clean_pdb(pdb_path, progress=None, remove_waters=False, keep_hydrogens=True, informative_filenames=False):
+    """Write cleaned copy of the pdb file, and return its path.
+
+    Used by the command line and tests. The plugin cleans Complexes with `clean_complex`,
+    which streams lines to the output file through `CleanedTopology.write`.
+    progress: optional ProgressTracker, advanced in its 'clean' stage as residues are processed.
+    """
     pdb_noext, pdb_ext = os.path.splitext(pdb_path)
     pdb_ext = pdb_ext.replace('.', '')
 
@@ -59,9 +77,10 @@ def clean_pdb(pdb_path, plugin_instance=None, remove_waters=False, keep_hydrogen
     # REMOVE MULTIPLE MODELS
     # BY TAKING THE FIRST MODEL
     model = structure[0]
+    residues = list(model.get_residues())
 
     # RAISE AN ERROR FOR TOO MANY ATOMS
-    if len(list(model.get_atoms())) > 99999:
+    if sum(len(residue.child_list) for residue in residues) > 99999:
         try:
             raise ValueError('More than 99999 atoms in the PDB model!')
         except Exception:
@@ -85,11 +104,11 @@ def clean_pdb(pdb_path, plugin_instance=None, remove_waters=False, keep_hydrogen
         chain_polypeptides[chain_id] = []
 
     # GET ALL POLYPEPTIDE RESIDUES IN THE MODEL
-    polypeptide_residues = []
+    polypeptide_residue_ids = set()
 
     for pp in polypeptides:
         for res in pp:
-            polypeptide_residues.append(res)
+            polypeptide_residue_ids.add(res.get_full_id())
 
     # GET THE CHAIN_ID(S) ASSOCIATED WITH EACH POLYPEPTIDE
     polypeptide_chain_id_sets = [set([k.get_parent().id for k in x]) for x in polypeptides]
@@ -119,52 +138,71 @@ def clean_pdb(pdb_path, plugin_instance=None, remove_waters=False, keep_hydrogen
 
     # WRITE OUT CLEANED PDB
     # MANY OF THE ISSUES ARE SOLVED DURING THE WRITING OUT
-    res_count = sum(1 for _ in model.get_residues())
+    res_count = len(residues)
     output_filepath = '.'.join((pdb_noext, output_label, pdb_ext))
-    loading_bar_increment = math.ceil(res_count * 0.03)
 
     starting_atom_serial = 1
-    output_lines = []
 
-    residue_iter = model.get_residues()
-    thread_count = max(res_count // 1000, 1)
-    futs = []
-    with ThreadPoolExecutor(max_workers=thread_count) as executor:
-        for i, residue in enumerate(residue_iter):
-            # Logs.debug(f'Residue {i} / {res_count}: {residue}')
-            if i % loading_bar_increment == 0 and plugin_instance:
-                plugin_instance.menu.update_loading_bar(i, res_count)
-            ending_atom_serial = starting_atom_serial + sum(1 for _ in residue.get_atoms())
-            fut = executor.submit(clean_residue, residue, polypeptide_residues, remove_waters, keep_hydrogens, starting_atom_serial)
-            futs.append(fut)
-            starting_atom_serial = ending_atom_serial
-    for fut in futs:
-        residue_pdb_lines = fut.result()
-        output_lines.extend(residue_pdb_lines)
-    with open(output_filepath, 'w') as fo:
-        for output_line in output_lines:
-            fo.write(output_line)
-            fo.write("\n")
-
-    if plugin_instance:
-        plugin_instance.menu.update_loading_bar(0, res_count)
+    if progress:
+        progress.set_total('clean', res_count)
+    thread_count = max(res_count // RESIDUE_BATCH_SIZE, 1)
+    # Batches are written in order as soon as they are cleaned,
+    # so at most max_pending_batches batches of lines are held in memory.
+    max_pending_batches = 2 * thread_count
+    pending_futs = deque()
+    with open(output_filepath, 'w') as fo, ThreadPoolExecutor(max_workers=thread_count) as executor:
+        for batch_start in range(0, res_count, RESIDUE_BATCH_SIZE):
+            residue_batch = residues[batch_start:batch_start + RESIDUE_BATCH_SIZE]
+            fut = executor.submit(
+                clean_residues, residue_batch, polypeptide_residue_ids, remove_waters, keep_hydrogens,
+                starting_atom_serial, progress)
+            pending_futs.append(fut)
+            # Serials are numbered as if every atom is written, so each batch knows where to start.
+            starting_atom_serial += sum(len(residue.child_list) for residue in residue_batch)
+            while pending_futs and (len(pending_futs) > max_pending_batches or pending_futs[0].done()):
+                write_lines(fo, pending_futs.popleft().result())
+        while pending_futs:
+            write_lines(fo, pending_futs.popleft().result())
+
+    if progress:
+        progress.complete('clean')
     return output_filepath
 
 
-def clean_residue(residue, polypeptide_residues, remove_waters, keep_hydrogens, atom_serial):
+def write_lines(fo, output_lines):
+    for output_line in output_lines:
+        fo.write(output_line)
+        fo.write("\n")
+
+
+def clean_residues(residues, polypeptide_residue_ids, remove_waters, keep_hydrogens, atom_serial, progress=None):
+    """Return cleaned pdb lines for a batch of consecutive residues, numbering atoms from atom_serial."""
+    output_lines = []
+    for residue in residues:
+        output_lines.extend(
+            clean_residue(residue, polypeptide_residue_ids, remove_waters, keep_hydrogens, atom_serial))
+        atom_serial += len(residue.child_list)
+    if progress:
+        progress.advance('clean', len(residues))
+    return output_lines
+
+
+def clean_residue(residue, polypeptide_residue_ids, remove_waters, keep_hydrogens, atom_serial):
+    residue_hetflag = residue.get_id()[0]
     # REMOVE WATERS IF FLAG SET
     if remove_waters:
-        if residue.get_full_id()[3][0] == 'W':
-            return
+        if residue_hetflag == 'W':
+            return []
 
     record = 'ATOM'
 
     # SET HETATM RECORD IF IT WAS ORIGINALLY A HETATM OR WATER
-    if residue.get_full_id()[3][0] == 'W' or residue.get_full_id()[3][0].startswith('H_'):
+    if residue_hetflag == 'W' or residue_hetflag.startswith('H_'):
         record = 'HETATM'
 
     # SET ATOM RECORD IF THE RESIDUE IS IN A POLYPEPETIDE
-    if residue in polypeptide_residues:
+    in_polypeptide = residue.get_full_id() in polypeptide_residue_ids
+    if in_polypeptide:
         record = 'ATOM'
 
     output_lines = []
@@ -180,7 +218,7 @@ def clean_residue(residue, polypeptide_residues, remove_waters, keep_hydrogens,
                 continue
 
         # CONVERT SELENOMETHIONINES TO METHIONINES
-        if residue in polypeptide_residues and (residue.resname == 'MSE' or residue.resname == 'MET'):
+        if in_polypeptide and (residue.resname == 'MSE' or residue.resname == 'MET'):
             residue.resname = 'MET'
 
             if atom.name == 'SE' and atom.element == 'SE':
@@ -217,6 +255,390 @@ def clean_residue(residue, polypeptide_residues, remove_waters, keep_hydrogens,
     return output_lines
 
 
+class ModelAtom:
+    """Atom of a ModelResidue, holding the values PDBParser would read from a pdb file.
+
+    slot: position of the atom in the complex's first molecule, where its coordinates are looked up.
+    """
+
+    def __init__(self, name, fullname, slot, bfactor, element):
+        self.name = name
+        self.fullname = fullname
+        self.slot = slot
+        self.bfactor = bfactor
+        self.element = element
+
+
+class ModelResidue:
+    """Residue of the first model of a Complex, grouped the same way PDBParser groups residues."""
+
+    def __init__(self, chain_id, hetflag, resseq, resname):
+        self.chain_id = chain_id
+        self.hetflag = hetflag
+        self.resseq = resseq
+        self.icode = ' '
+        self.resname = resname
+        self.atoms = OrderedDict()
+
+
+def get_model_residues(complex):
+    """Return list of ModelResidues for the first model of the complex, in pdb order.
+
+    Mirrors what PDBParser reads back from a file written by `Complex.io.to_pdb`, so cleaning
+    produces the same output without the round trip through disk.
+    Atom names repeated within a residue (alternate locations) keep their first occurrence.
+    """
+    molecule = next(complex.molecules, None)
+    if molecule is None:
+        return []
+    # chain_id -> OrderedDict of residue id -> ModelResidue
+    chains = OrderedDict()
+    chain_residues = None
+    current_chain_id = None
+    current_residue_key = None
+    residue = None
+    slot = -1
+    for chain in molecule.chains:
+        chain_id = chain.name[1] if len(chain.name) > 1 else chain.name.rjust(1)
+        for nanome_residue in chain.residues:
+            resname = nanome_residue.name.rjust(3)[:3].strip()
+            for atom in nanome_residue.atoms:
+                slot += 1
+                if not atom.in_conformer[0]:
+                    continue
+                if atom.is_het:
+                    hetflag = 'W' if resname in ('HOH', 'WAT') else 'H_' + resname
+                else:
+                    hetflag = ' '
+                residue_key = (hetflag, nanome_residue.serial, resname)
+                if chain_id != current_chain_id:
+                    current_chain_id = chain_id
+                    chain_residues = chains.setdefault(chain_id, OrderedDict())
+                    current_residue_key = None
+                if residue_key != current_residue_key:
+                    current_residue_key = residue_key
+                    residue = _init_model_residue(chain_residues, chain_id, hetflag, nanome_residue.serial, resname)
+                if residue is None:
+                    continue
+                _add_model_atom(residue, atom, slot)
+    return [residue for chain_residues in chains.values() for residue in chain_residues.values()]
+
+
+def _init_model_residue(chain_residues, chain_id, hetflag, resseq, resname):
+    """Return residue that the following atoms are added to, or None if PDBParser would drop them."""
+    res_id = (hetflag, resseq)
+    duplicate_residue = chain_residues.get(res_id)
+    if duplicate_residue is not None:
+        # Redefined standard residues with the same name are continued, anything else is discarded.
+        if hetflag == ' ' and duplicate_residue.resname == resname:
+            return duplicate_residue
+        return None
+    residue = ModelResidue(chain_id, hetflag, resseq, resname)
+    chain_residues[res_id] = residue
+    return residue
+
+
+def _add_model_atom(residue, atom, slot):
+    atom_name = atom.name if atom.name is not None else atom.symbol
+    fullname = atom_name.ljust(3).rjust(4)
+    split_name = fullname.split()
+    name = split_name[0] if len(split_name) == 1 else fullname
+    duplicate_atom = residue.atoms.get(name)
+    if duplicate_atom is not None:
+        if duplicate_atom.fullname == fullname:
+            return
+        name = fullname
+        if name in residue.atoms:
+            return
+    # B-factors are rounded the same way they are written to pdb files.
+    bfactor = round(atom.bfactor, 2)
+    element = _assign_element(name, fullname, atom.symbol.strip().upper())
+    residue.atoms[name] = ModelAtom(name, fullname, slot, bfactor, element)
+
+
+def _assign_element(name, fullname, element):
+    """Validate element, or guess it from the atom name like Bio.PDB.Atom does."""
+    if element and element.capitalize() in atom_weights:
+        return element
+    if fullname[0].isalpha() and not fullname[2:].isdigit():
+        putative_element = name.strip()
+    elif name[0].isdigit():
+        putative_element = name[1]
+    else:
+        putative_element = name[0]
+    return putative_element if putative_element.capitalize() in atom_weights else 'X'
+
+
+def get_model_positions(complex):
+    """Return list of (x, y, z) positions of every atom in the complex's first molecule, in pdb order."""
+    molecule = next(complex.molecules, None)
+    if molecule is None:
+        return []
+    return [(position.x, position.y, position.z) for position in (atom.positions[0] for atom in molecule.atoms)]
+
+
+def round_coordinates(positions):
+    """Return float32 array of positions, rounded the same way they are written to pdb files."""
+    values = np.array(positions, dtype=np.float64).reshape(-1, 3)
+    scaled = values * 1000
+    rounded = np.rint(scaled) / 1000
+    # Values close to a rounding boundary may land on either side after scaling, round those exactly.
+    near_boundary = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for index in zip(*np.nonzero(near_boundary)):
+        rounded[index] = round(float(values[index]), 3)
+    return rounded.astype(np.float32)
+
+
+class CleanedTopology:
+    """Coordinate independent part of cleaning the first model of a complex.
+
+    Holds residues grouped as PDBParser would, and the consecutive residues PPBuilder could link into a
+    polypeptide. Record types, MSE conversion and formatted line parts are worked out once per residue,
+    so complexes that only differ in coordinates are cleaned by rewriting coordinates.
+    """
+
+    def __init__(self, residues, remove_waters=False, keep_hydrogens=True):
+        self.residues = residues
+        self.remove_waters = remove_waters
+        self.keep_hydrogens = keep_hydrogens
+        # Serials are numbered as if every atom is written.
+        self.residue_serials = []
+        atom_serial = 1
+        for residue in residues:
+            self.residue_serials.append(atom_serial)
+            atom_serial += len(residue.atoms)
+        if atom_serial - 1 > 99999:
+            raise ValueError('More than 99999 atoms in the PDB model!')
+
+        # (previous residue index, C atom slot, N atom slot), linked if the atoms are within PEPTIDE_BOND_RADIUS.
+        self.peptide_links = []
+        for i in range(1, len(residues)):
+            prev_res = residues[i - 1]
+            residue = residues[i]
+            if prev_res.chain_id != residue.chain_id or not (self._accept(prev_res) and self._accept(residue)):
+                continue
+            c_atom = prev_res.atoms.get('C')
+            n_atom = residue.atoms.get('N')
+            if c_atom is not None and n_atom is not None:
+                self.peptide_links.append((i - 1, c_atom.slot, n_atom.slot))
+        # (residue index, in_polypeptide) -> list of (line prefix, atom slot, line suffix)
+        self._line_parts = {}
+
+    @classmethod
+    def from_complex(cls, complex, remove_waters=False, keep_hydrogens=True):
+        return cls(get_model_residues(complex), remove_waters, keep_hydrogens)
+
+    @staticmethod
+    def _accept(residue):
+        return is_aa(f'{residue.resname:<3s}') or 'CA' in residue.atoms
+
+    def get_polypeptide_residues(self, coords):
+        """Return set of indices of residues that belong to a polypeptide, following PPBuilder(aa_only=False) rules."""
+        polypeptide_residues = set()
+        for prev_index, c_slot, n_slot in self.peptide_links:
+            diff = coords[c_slot] - coords[n_slot]
+            if np.sqrt(np.dot(diff, diff)) < PEPTIDE_BOND_RADIUS:
+                polypeptide_residues.add(prev_index)
+                polypeptide_residues.add(prev_index + 1)
+        return polypeptide_residues
+
+    def get_line_parts(self, residue_index, in_polypeptide):
+        key = (residue_index, in_polypeptide)
+        line_parts = self._line_parts.get(key)
+        if line_parts is None:
+            line_parts = self._line_parts[key] = clean_model_residue(
+                self.residues[residue_index], in_polypeptide, self.remove_waters, self.keep_hydrogens,
+                self.residue_serials[residue_index])
+        return line_parts
+
+    def write(self, coords, output_filepath, progress=None):
+        """Write cleaned pdb with the provided coordinates (see round_coordinates) to output_filepath.
+
+        progress: optional ProgressTracker, advanced in its 'clean' stage as residues are processed.
+        """
+        polypeptide_residues = self.get_polypeptide_residues(coords)
+        coord_rows = coords.tolist()
+        res_count = len(self.residues)
+        if progress:
+            progress.set_total('clean', res_count)
+        with open(output_filepath, 'w') as fo:
+            for batch_start in range(0, res_count, RESIDUE_BATCH_SIZE):
+                batch_end = min(batch_start + RESIDUE_BATCH_SIZE, res_count)
+                for residue_index in range(batch_start, batch_end):
+                    line_parts = self.get_line_parts(residue_index, residue_index in polypeptide_residues)
+                    for prefix, slot, suffix in line_parts:
+                        x, y, z = coord_rows[slot]
+                        fo.write(prefix)
+                        fo.write(PDB_COORDINATES_TEMPLATE.format(x=x, y=y, z=z))
+                        fo.write(suffix)
+                        fo.write("\n")
+                if progress:
+                    progress.advance('clean', batch_end - batch_start)
+        if progress:
+            progress.complete('clean')
+        return output_filepath
+
+
+def clean_complex(complex, output_filepath, progress=None, remove_waters=False, keep_hydrogens=True):
+    """Write cleaned pdb of the complex's first model to output_filepath, and return the path.
+
+    Output matches writing the complex with `Complex.io.to_pdb` and running `clean_pdb` on that file,
+    but lines are streamed to output_filepath straight from the Complex.
+    progress: optional ProgressTracker, advanced in its 'clean' stage as residues are processed.
+    """
+    topology = CleanedTopology.from_complex(complex, remove_waters, keep_hydrogens)
+    coords = round_coordinates(get_model_positions(complex))
+    return topology.write(coords, output_filepath, progress=progress)
+
+
+def clean_model_residue(residue, in_polypeptide, remove_waters, keep_hydrogens, atom_serial):
+    """Return list of (line prefix, atom slot, line suffix) for the cleaned pdb lines of a ModelResidue.
+
+    Applies the same fixes as clean_residue, coordinates are filled in when the lines are written.
+    """
+    if remove_waters and residue.hetflag == 'W':
+        return []
+
+    record = 'ATOM'
+    if not in_polypeptide and (residue.hetflag == 'W' or residue.hetflag.startswith('H_')):
+        record = 'HETATM'
+
+    resname = residue.resname
+    convert_mse = in_polypeptide and resname in ('MSE', 'MET')
+    if convert_mse:
+        resname = 'MET'
+
+    line_parts = []
+    for atom in residue.atoms.values():
+        if not keep_hydrogens and atom.element.strip() == 'H':
+            continue
+        atom_name = atom.name
+        element = atom.element
+        if convert_mse and atom_name == 'SE' and element == 'SE':
+            atom_name = 'SD'
+            element = 'S'
+        if len(atom_name) == 3:
+            atom_name = ' ' + atom_name
+        prefix = PDB_LINE_PREFIX_TEMPLATE.format(
+            record=record,
+            serial=atom_serial,
+            atom_name=atom_name,
+            altloc=' ',
+            resname=resname,
+            chain_id=residue.chain_id,
+            resnum=residue.resseq,
+            icode=residue.icode)
+        suffix = PDB_LINE_SUFFIX_TEMPLATE.format(
+            occ=1.00,
+            tfac=atom.bfactor,
+            element=element,
+            charge='')
+        line_parts.append((prefix, atom.slot, suffix))
+        atom_serial += 1
+    return line_parts
+
+
+def get_complex_fingerprints(complex, remove_waters=False, keep_hydrogens=True):
+    """Return (topology fingerprint, fingerprint, positions) for the complex's first model.
+
+    The topology fingerprint covers everything clean_complex output depends on except coordinates:
+    chain and residue names and serials, atom names, elements, het flags, b-factors and the cleaning flags.
+    The fingerprint also covers coordinates. positions are returned as in get_model_positions.
+    """
+    topology_hasher = hashlib.sha1(f'{remove_waters},{keep_hydrogens}'.encode())
+    names = []
+    atom_values = []
+    positions = []
+    molecule = next(complex.molecules, None)
+    for chain in (molecule.chains if molecule is not None else []):
+        names.append(f'C{chain.name}')
+        for residue in chain.residues:
+            atom_names = []
+            for atom in residue.atoms:
+                position = atom.positions[0]
+                atom_names.append(f'{atom.name}\t{atom.symbol}')
+                atom_values.append((atom.bfactor, atom.is_het, atom.in_conformer[0]))
+                positions.append((position.x, position.y, position.z))
+            names.append(f'R{residue.name}\t{residue.serial}\t{len(atom_names)}')
+            names.extend(atom_names)
+    topology_hasher.update('\n'.join(names).encode())
+    topology_hasher.update(np.array(atom_values, dtype=np.float64).tobytes())
+    topology_fingerprint = topology_hasher.hexdigest()
+    hasher = hashlib.sha1(topology_fingerprint.encode())
+    hasher.update(np.array(positions, dtype=np.float64).tobytes())
+    return topology_fingerprint, hasher.hexdigest(), positions
+
+
+class CleanedPdbCache:
+    """LRU cache of cleaned pdb files in cache_dir, keyed by complex fingerprint.
+
+    Recalculating interactions for an unchanged structure reuses the cleaned file from the previous run.
+    CleanedTopologies are cached too, so structures where only coordinates changed skip the topology pass.
+    max_entries: number of cleaned files (and topologies) kept, least recently used are dropped first.
+    """
+
+    def __init__(self, cache_dir, max_entries=8):
+        self.cache_dir = cache_dir
+        self.max_entries = max(max_entries, 1)
+        # fingerprint -> cleaned filepath, from least to most recently used.
+        self._entries = OrderedDict()
+        # topology fingerprint -> CleanedTopology, from least to most recently used.
+        self._topologies = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, fingerprint):
+        """Return path of cached file for fingerprint, or None."""
+        filepath = self._entries.get(fingerprint)
+        if filepath is None:
+            return None
+        if not os.path.exists(filepath):
+            del self._entries[fingerprint]
+            return None
+        self._entries.move_to_end(fingerprint)
+        return filepath
+
+    def add(self, fingerprint, filepath):
+        self._entries[fingerprint] = filepath
+        self._entries.move_to_end(fingerprint)
+        while len(self._entries) > self.max_entries:
+            _, evicted_filepath = self._entries.popitem(last=False)
+            if os.path.exists(evicted_filepath):
+                os.remove(evicted_filepath)
+
+    def get_topology(self, topology_fingerprint):
+        """Return cached CleanedTopology for topology_fingerprint, or None."""
+        topology = self._topologies.get(topology_fingerprint)
+        if topology is not None:
+            self._topologies.move_to_end(topology_fingerprint)
+        return topology
+
+    def add_topology(self, topology_fingerprint, topology):
+        self._topologies[topology_fingerprint] = topology
+        self._topologies.move_to_end(topology_fingerprint)
+        while len(self._topologies) > self.max_entries:
+            self._topologies.popitem(last=False)
+
+    def clean_complex(self, complex, progress=None, remove_waters=False, keep_hydrogens=True):
+        """Return path of cleaned pdb for complex, only cleaning what changed since cached runs."""
+        topology_fingerprint, fingerprint, positions = get_complex_fingerprints(complex, remove_waters, keep_hydrogens)
+        filepath = self.get(fingerprint)
+        if filepath is not None:
+            if progress:
+                progress.complete('clean')
+            return filepath
+
+        topology = self.get_topology(topology_fingerprint)
+        if topology is None:
+            topology = CleanedTopology.from_complex(complex, remove_waters, keep_hydrogens)
+            self.add_topology(topology_fingerprint, topology)
+        filepath = os.path.join(self.cache_dir, f'{fingerprint}.clean.pdb')
+        topology.write(round_coordinates(positions), filepath, progress=progress)
+        self.add(fingerprint, filepath)
+        return filepath
+
+
 # MAIN
 if __name__ == '__main__':
     # ARGUMENT PARSING
@@ -244,4 +666,6 @@ if __name__ == '__main__':
     informative_filenames = args.informative_filenames
     remove_waters = args.remove_waters
     keep_hydrogens = args.keep_hydrogens
-    clean_pdb(pdb_path, remove_waters, keep_hydrogens, informative_filenames)
+    clean_pdb(
+        pdb_path, remove_waters=remove_waters, keep_hydrogens=keep_hydrogens,
+        informative_filenames=informative_filenames)
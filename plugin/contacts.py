@@ -0,0 +1,333 @@
+import json
+import os
+import pickle
+from enum import IntEnum
+
+import numpy as np
+from nanome.util.enums import InteractionKind
+
+from .models import AtomNotFoundException
+from .utils import interaction_type_map
+
+
+__all__ = [
+    'ContactsReader', 'ContactsTable', 'InteractingEntity', 'InteractionKindTable', 'contact_type_mask',
+    'iter_json_array', 'load_worker_atom_table', 'parse_contact_specs'
+]
+
+# Each Arpeggio contact type is assigned a bit, in the order of interaction_type_map.
+CONTACT_TYPES = tuple(interaction_type_map.keys())
+CONTACT_TYPE_BITS = {contact_type: 1 << i for i, contact_type in enumerate(CONTACT_TYPES)}
+
+UNKNOWN_ENTITY = -1
+
+
+class InteractingEntity(IntEnum):
+    """Relationship between the two structures in a contact, as reported by Arpeggio."""
+    INTER = 0
+    INTRA_SELECTION = 1
+    SELECTION_WATER = 2
+    INTRA_NON_SELECTION = 3
+    NON_SELECTION_WATER = 4
+    WATER_WATER = 5
+
+
+def contact_type_mask(contact_types):
+    """Return bitmask for the provided Arpeggio contact types. Unknown types are ignored."""
+    mask = 0
+    for contact_type in contact_types:
+        mask |= CONTACT_TYPE_BITS.get(contact_type, 0)
+    return mask
+
+
+class InteractionKindTable:
+    """Lookup table from contact type bitmasks to the InteractionKinds that should be drawn.
+
+    Compiled once per run from line settings, so rows can be accepted or rejected with
+    a single AND against `accepted_mask`, and line creation gets enums and settings directly.
+    """
+
+    def __init__(self, line_settings):
+        self.entries = []
+        self.accepted_mask = 0
+        for contact_type, interaction_kind in interaction_type_map.items():
+            kind_settings = line_settings.get(interaction_kind.name)
+            if not kind_settings or interaction_kind == InteractionKind.All:
+                continue
+            bit = CONTACT_TYPE_BITS[contact_type]
+            self.entries.append((bit, interaction_kind, kind_settings))
+            self.accepted_mask |= bit
+        self._kinds_by_mask = {}
+
+    def get_kinds(self, mask):
+        """Return list of (InteractionKind, line settings) tuples for the contact types in mask."""
+        kinds = self._kinds_by_mask.get(mask)
+        if kinds is None:
+            kinds = [
+                (interaction_kind, kind_settings)
+                for bit, interaction_kind, kind_settings in self.entries
+                if mask & bit
+            ]
+            self._kinds_by_mask[mask] = kinds
+        return kinds
+
+
+def get_atom_path(atom_data):
+    return f"{atom_data['auth_asym_id']}/{atom_data['auth_seq_id']}/{atom_data['auth_atom_id']}"
+
+
+class ContactsTable:
+    """Columnar representation of the contacts returned by Arpeggio.
+
+    Atom paths are interned, so each row only stores integer ids into `atom_paths`.
+    Contact types are stored as a bitmask (see CONTACT_TYPE_BITS), and interacting entities as InteractingEntity values.
+    """
+
+    def __init__(self, atom_paths, bgn, end, contact_mask, entity, distance):
+        self.atom_paths = atom_paths
+        self.bgn = bgn
+        self.end = end
+        self.contact_mask = contact_mask
+        self.entity = entity
+        self.distance = distance
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build table from the list of dicts contained in Arpeggio's json output."""
+        atom_paths = []
+        path_ids = {}
+        row_count = len(rows)
+        bgn = np.empty(row_count, dtype=np.int32)
+        end = np.empty(row_count, dtype=np.int32)
+        contact_mask = np.empty(row_count, dtype=np.uint32)
+        entity = np.empty(row_count, dtype=np.int8)
+        distance = np.empty(row_count, dtype=np.float32)
+        for i, row in enumerate(rows):
+            for column, atom_data in ((bgn, row['bgn']), (end, row['end'])):
+                atom_path = get_atom_path(atom_data)
+                path_id = path_ids.get(atom_path)
+                if path_id is None:
+                    path_id = path_ids[atom_path] = len(atom_paths)
+                    atom_paths.append(atom_path)
+                column[i] = path_id
+            contact_mask[i] = contact_type_mask(row['contact'])
+            entity_name = row['interacting_entities']
+            entity[i] = InteractingEntity[entity_name] if entity_name in InteractingEntity.__members__ else UNKNOWN_ENTITY
+            distance[i] = row.get('distance', np.nan)
+        return cls(atom_paths, bgn, end, contact_mask, entity, distance)
+
+    def __len__(self):
+        return len(self.contact_mask)
+
+    def __getitem__(self, key):
+        """Slice or boolean mask rows into a new table. Interned atom paths are shared."""
+        return ContactsTable(
+            self.atom_paths, self.bgn[key], self.end[key],
+            self.contact_mask[key], self.entity[key], self.distance[key])
+
+    def entity_filter(self, interacting_entities):
+        """Return boolean array marking rows with one of the provided interacting entities (str names)."""
+        entity_values = [
+            InteractingEntity[name] for name in interacting_entities
+            if name in InteractingEntity.__members__
+        ]
+        return np.isin(self.entity, entity_values)
+
+    def contact_filter(self, mask):
+        """Return boolean array marking rows that have any of the contact types in mask."""
+        return (self.contact_mask & np.uint32(mask)) != 0
+
+    @classmethod
+    def from_file(cls, filepath):
+        """Load all contacts from Arpeggio's json output file."""
+        with open(filepath, 'r') as f:
+            rows = list(iter_json_array(f.read))
+        return cls.from_rows(rows)
+
+    def compact(self):
+        """Return copy of table whose atom_paths only contains the paths referenced by its rows.
+
+        Used to keep chunks small when they are sent to worker processes.
+        """
+        row_count = len(self)
+        path_ids, new_ids = np.unique(np.concatenate([self.bgn, self.end]), return_inverse=True)
+        atom_paths = [self.atom_paths[path_id] for path_id in path_ids.tolist()]
+        new_ids = new_ids.astype(np.int32)
+        return ContactsTable(
+            atom_paths, new_ids[:row_count], new_ids[row_count:],
+            self.contact_mask, self.entity, self.distance)
+
+    def renderable_rows(self, accepted_mask, interacting_entities):
+        """Return table containing only rows with accepted contact types and interacting entities."""
+        row_filter = self.contact_filter(accepted_mask)
+        row_filter &= self.entity_filter(interacting_entities)
+        return self[row_filter]
+
+    def iter_rows(self):
+        """Yield (atom1_path, atom2_path, contact_mask) for every row."""
+        atom_paths = self.atom_paths
+        for bgn_id, end_id, mask in zip(self.bgn.tolist(), self.end.tolist(), self.contact_mask.tolist()):
+            yield atom_paths[bgn_id], atom_paths[end_id], mask
+
+    @staticmethod
+    def contact_types(mask):
+        """Return list of contact type names contained in mask."""
+        return [contact_type for contact_type, bit in CONTACT_TYPE_BITS.items() if mask & bit]
+
+
+def iter_json_array(read, read_size=1 << 16):
+    """Incrementally decode a json array, yielding each element as soon as it has been read.
+
+    read: callable returning the next read_size characters of the json text, e.g file.read
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    while True:
+        # Skip whitespace and separators, reading more text when the buffer runs out.
+        while pos < len(buffer) and buffer[pos] in ' \t\n\r,':
+            pos += 1
+        if pos == len(buffer):
+            text = read(read_size)
+            if not text:
+                raise ValueError('Unexpected end of json array')
+            buffer = buffer[pos:] + text
+            pos = 0
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('Expected json array')
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            element, end = None, None
+        next_pos = end
+        while next_pos is not None and next_pos < len(buffer) and buffer[next_pos] in ' \t\n\r':
+            next_pos += 1
+        if end is None or next_pos == len(buffer) or buffer[next_pos] not in ',]':
+            # Element is incomplete, or may be, unless it is followed by a separator.
+            # e.g a number cut off at the end of the buffer, or after its '.' or 'e'.
+            text = read(read_size)
+            if text:
+                buffer = buffer[pos:] + text
+                pos = 0
+                continue
+            if end is None:
+                raise ValueError('Unexpected end of json array')
+        yield element
+        pos = end
+
+
+class ContactsReader:
+    """Stream contacts from Arpeggio's json output file as ContactsTables of at most batch_size rows.
+
+    Peak memory is bounded by the batch size rather than the size of the file.
+    """
+
+    def __init__(self, filepath, batch_size=10000):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.file_size = os.path.getsize(filepath)
+        self.chars_read = 0
+        self.rows_read = 0
+
+    @property
+    def estimated_row_count(self):
+        """Estimate total rows in the file, based on how much of it has been read so far."""
+        if not self.chars_read:
+            return self.rows_read
+        return max(self.rows_read, round(self.rows_read * self.file_size / self.chars_read))
+
+    def __iter__(self):
+        with open(self.filepath, 'r') as f:
+            def read(size):
+                text = f.read(size)
+                self.chars_read += len(text)
+                return text
+
+            batch = []
+            for row in iter_json_array(read):
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.rows_read += len(batch)
+                    yield ContactsTable.from_rows(batch)
+                    batch = []
+            if batch:
+                self.rows_read += len(batch)
+                yield ContactsTable.from_rows(batch)
+
+
+# Worker processes outlive a run, so they keep the AtomTable of the latest run,
+# loaded once from the file written by the parent rather than sent with every chunk.
+_worker_atom_table_path = None
+_worker_atom_table = None
+
+
+def load_worker_atom_table(atom_table_path):
+    """Return the pickled AtomTable at atom_table_path, loading it if it isn't the current one."""
+    global _worker_atom_table, _worker_atom_table_path
+    if atom_table_path != _worker_atom_table_path:
+        with open(atom_table_path, 'rb') as f:
+            _worker_atom_table = pickle.load(f)
+        _worker_atom_table_path = atom_table_path
+    return _worker_atom_table
+
+
+def _resolve_atom_indices(atom_table, atom_path):
+    """Return tuple of atom indices for the atom path, which may describe an aromatic ring."""
+    if ',' not in atom_path:
+        atom_index = atom_table.get_atom_index(atom_path)
+        return (atom_index,) if atom_index is not None else ()
+    chain_name, res_id, atom_names = atom_path.split('/')
+    atom_indices = []
+    for atom_name in atom_names.split(','):
+        atom_index = atom_table.get_atom_index(f'{chain_name}/{res_id}/{atom_name}')
+        if atom_index is not None:
+            atom_indices.append(atom_index)
+    return tuple(atom_indices)
+
+
+def parse_contact_specs(contacts_data, atom_table_path, selected_atoms_only=False):
+    """Resolve a chunk of contacts into compact line specs. Runs in a worker process.
+
+    atom_table_path: file containing the pickled AtomTable for this run.
+
+    Each spec is a tuple of
+    (contact_mask, struct1 atom indices, struct1 frame, struct1 conformer,
+    struct2 atom indices, struct2 frame, struct2 conformer)
+
+    :rtype: (specs, skipped_rows), where skipped_rows lists (atom1_path, atom2_path, contact_mask)
+        for rows whose atoms couldn't be found, so they can be logged by the parent process.
+    """
+    atom_table = load_worker_atom_table(atom_table_path)
+    atom_data = atom_table.atom_data
+    specs = []
+    skipped_rows = []
+    for atom1_path, atom2_path, mask in contacts_data.iter_rows():
+        try:
+            struct1_indices = _resolve_atom_indices(atom_table, atom1_path)
+            struct2_indices = _resolve_atom_indices(atom_table, atom2_path)
+        except AtomNotFoundException:
+            struct1_indices = struct2_indices = ()
+        if not struct1_indices or not struct2_indices:
+            skipped_rows.append((atom1_path, atom2_path, mask))
+            continue
+        # if selected_atoms_only = True, and neither of the structures contain selected atoms, don't draw line
+        if selected_atoms_only and not any(
+                atom_data[atom_index][2] for atom_index in struct1_indices + struct2_indices):
+            continue
+        struct1_frame, struct1_conformer, _ = atom_data[struct1_indices[0]]
+        struct2_frame, struct2_conformer, _ = atom_data[struct2_indices[0]]
+        specs.append((
+            mask,
+            struct1_indices, struct1_frame, struct1_conformer,
+            struct2_indices, struct2_frame, struct2_conformer))
+    return specs, skipped_rows
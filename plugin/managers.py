@@ -1,44 +1,112 @@
+import asyncio
 import itertools
-from collections import defaultdict
-from nanome.api.shapes import Label, Shape
+from collections import defaultdict, deque
+from nanome.api.shapes import Anchor, Label, Shape
 from nanome.api.structure import Molecule
 from nanome.api.interactions import Interaction
-from nanome.util import enums, Color, Logs
+from nanome.util import enums, Color, Logs, Vector3
 from .models import InteractionShapesLine, InteractionStructure
 from . import utils
 
 
+class LineIndex:
+    """Hash index of interaction lines, keyed by the structures, conformers, and kind of each line.
+
+    Lets us check whether a line has already been drawn with a single dict lookup.
+    Keys looked up with `match` are recorded, so lines that weren't found again can be listed afterwards.
+    Duplicate lines share a key; only the first one is kept when the key is matched.
+    """
+
+    def __init__(self, lines=None):
+        self._data = defaultdict(list)
+        self.matched_keys = set()
+        for line in lines or []:
+            self.add_line(line)
+
+    @staticmethod
+    def get_key(atom1_indices, atom1_conformation, atom2_indices, atom2_conformation, kind):
+        """Return key that is the same regardless of atom order, or which structure is first."""
+        struct1_key = (tuple(sorted(atom1_indices)), atom1_conformation)
+        struct2_key = (tuple(sorted(atom2_indices)), atom2_conformation)
+        return (kind, frozenset([struct1_key, struct2_key]))
+
+    @classmethod
+    def get_line_key(cls, line):
+        return cls.get_key(
+            line.atom1_idx_arr, line.atom1_conformation,
+            line.atom2_idx_arr, line.atom2_conformation, line.kind)
+
+    @classmethod
+    def get_structpair_key(cls, struct1: InteractionStructure, struct2: InteractionStructure, kind):
+        """Return key for a line of the given kind drawn between the two structures."""
+        return cls.get_key(struct1.index, struct1.conformer, struct2.index, struct2.conformer, kind)
+
+    def add_line(self, line):
+        self._data[self.get_line_key(line)].append(line)
+
+    def match(self, key):
+        """Return whether a line exists for key, and record key as matched if it does."""
+        if key not in self._data:
+            return False
+        self.matched_keys.add(key)
+        return True
+
+    def matched_lines(self):
+        """Return the first line for each matched key."""
+        return [self._data[key][0] for key in self.matched_keys]
+
+    def unmatched_lines(self, line_list=None):
+        """Return lines from line_list (default all lines) that aren't kept by a matched key.
+
+        Duplicates of a matched line are included, so they can be destroyed along with the vanished lines.
+        """
+        if line_list is None:
+            line_list = itertools.chain.from_iterable(self._data.values())
+        unmatched = []
+        for line in line_list:
+            key = self.get_line_key(line)
+            if key not in self.matched_keys or self._data[key][0] is not line:
+                unmatched.append(line)
+        return unmatched
+
+
 class StructurePairManager:
 
     def __init__(self):
         super().__init__()
+        # Items are kept in insertion order, so they can be listed without sorting.
         self._data = defaultdict(list)
 
     @staticmethod
-    def get_structpair_key(struct1_key, struct2_key):
-        """Return a string key for the given atom indices."""
-        structpair_key = '|'.join(sorted([str(struct1_key), str(struct2_key)]))
-        return structpair_key
+    def get_struct_key(struct_key):
+        """Return sorted tuple of atom indices, given an atom index or tuple of atom indices."""
+        if isinstance(struct_key, tuple):
+            return tuple(sorted(struct_key))
+        return (struct_key,)
 
-    @staticmethod
-    def get_structpair_key_for_line(line):
-        """Return a string key for the given atom indices."""
-        sorted_atom1_idx_arr = sorted(line.atom1_idx_arr)
-        sorted_atom2_idx_arr = sorted(line.atom2_idx_arr)
-        struct1_key = ','.join([str(x) for x in sorted_atom1_idx_arr])
-        struct2_key = ','.join([str(x) for x in sorted_atom2_idx_arr])
-        structpair_key = '|'.join(sorted([struct1_key, struct2_key]))
-        return structpair_key
+    @classmethod
+    def get_structpair_key(cls, struct1_key, struct2_key):
+        """Return a key for the given structure keys that is the same regardless of order.
+
+        Each key is either an atom index, or a tuple of atom indices (see InteractionStructure.index).
+        """
+        struct1_key = cls.get_struct_key(struct1_key)
+        struct2_key = cls.get_struct_key(struct2_key)
+        if struct2_key < struct1_key:
+            return (struct2_key, struct1_key)
+        return (struct1_key, struct2_key)
+
+    @classmethod
+    def get_structpair_key_for_line(cls, line):
+        """Return a key for the structures connected by line."""
+        return cls.get_structpair_key(tuple(line.atom1_idx_arr), tuple(line.atom2_idx_arr))
 
 
 class LabelManager(StructurePairManager):
 
     def all_labels(self):
-        """Return a flat list of all lines being stored."""
-        all_lines = []
-        for structpair_key, label in sorted(self._data.items(), key=lambda keyval: keyval[0]):
-            all_lines.append(self._data[structpair_key])
-        return all_lines
+        """Return a flat list of all labels being stored, in the order they were added."""
+        return list(self._data.values())
 
     def add_label(self, label, struct1_index, struct2_index):
         if not isinstance(label, Label):
@@ -66,20 +134,192 @@ class LabelManager(StructurePairManager):
             Shape.destroy_multiple(labels)
         self._data = {}
 
+    @staticmethod
+    def create_label(struct1_index, struct2_index, text):
+        """Create distance label anchored to the two atoms."""
+        label = Label()
+        label.text = text
+        label.font_size = 0.06
+        anchor1 = Anchor()
+        anchor2 = Anchor()
+        anchor1.target = struct1_index
+        anchor2.target = struct2_index
+        anchor1.anchor_type = enums.ShapeAnchorType.Atom
+        anchor2.anchor_type = enums.ShapeAnchorType.Atom
+        viewer_offset = Vector3(0, 0, -.01)
+        anchor1.viewer_offset = viewer_offset
+        anchor2.viewer_offset = viewer_offset
+        label.anchors = [anchor1, anchor2]
+        return label
+
+    async def reconcile(self, desired_labels):
+        """Update labels in workspace to match desired_labels.
+
+        desired_labels: list of (struct1_index, struct2_index, text) tuples.
+        Only labels that were added, removed, or whose text changed are sent to Nanome.
+        :rtype: tuple of (added, removed, updated) lists of Labels.
+        """
+        desired_data = {}
+        for struct1_index, struct2_index, text in desired_labels:
+            structpair_key = self.get_structpair_key(struct1_index, struct2_index)
+            desired_data[structpair_key] = (struct1_index, struct2_index, text)
+
+        removed = []
+        for structpair_key in list(self._data):
+            if structpair_key not in desired_data:
+                removed.append(self._data.pop(structpair_key))
+
+        added = []
+        updated = []
+        for structpair_key, (struct1_index, struct2_index, text) in desired_data.items():
+            label = self._data.get(structpair_key)
+            if label is None:
+                label = self.create_label(struct1_index, struct2_index, text)
+                self._data[structpair_key] = label
+                added.append(label)
+            elif label.text != text:
+                label.text = text
+                updated.append(label)
+
+        if removed:
+            Shape.destroy_multiple(removed)
+        if added or updated:
+            await Shape.upload_multiple(added + updated)
+        return added, removed, updated
+
+
+class InteractionMirror:
+    """Local copy of the persistent Interactions in the workspace, indexed by molecule, kind, and atom.
+
+    Interactions for a molecule are fetched from Nanome the first time they're requested,
+    and kept up to date with the lines we upload and destroy afterwards.
+    Call `invalidate` when the workspace may have changed without us, so lines are fetched again.
+    """
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        # All dicts store {id(line): line}, so lines are unique by identity and keep insertion order.
+        self._lines = {}
+        self._lines_by_molecule = defaultdict(dict)
+        self._lines_by_kind = defaultdict(dict)
+        self._lines_by_atom = defaultdict(dict)
+        self._fetched_all = False
+
+    async def get(self, molecules_idx=None):
+        """Return lines connected to the provided molecules, or all lines if molecules_idx is None."""
+        if molecules_idx is None:
+            if not self._fetched_all:
+                self._add_fetched_lines(await Interaction.get())
+                self._fetched_all = True
+            return list(self._lines.values())
+
+        lines = {}
+        for molecule_index in molecules_idx:
+            if molecule_index not in self._lines_by_molecule:
+                fetched_lines = self._add_fetched_lines(await Interaction.get(molecules_idx=[molecule_index]))
+                self._lines_by_molecule[molecule_index] = {id(line): line for line in fetched_lines}
+            lines.update(self._lines_by_molecule[molecule_index])
+        return list(lines.values())
+
+    def get_lines_for_kind(self, kind, molecules_idx=None):
+        """Return known lines of the provided InteractionKind, optionally only those connected to the molecules."""
+        kind_lines = self._lines_by_kind[kind].values()
+        if molecules_idx is None:
+            return list(kind_lines)
+        molecule_lines = [self._lines_by_molecule.get(molecule_index, {}) for molecule_index in molecules_idx]
+        return [
+            line for line in kind_lines
+            if any(id(line) in lines for lines in molecule_lines)
+        ]
+
+    def get_lines_for_atom(self, atom_index):
+        """Return all known lines connected to the atom."""
+        return list(self._lines_by_atom[atom_index].values())
+
+    def add(self, line_list, complexes=None):
+        """Add lines we uploaded to the mirror, once Nanome has acknowledged them and assigned their indices.
+
+        complexes: Complexes containing the lines' atoms, used to index lines by molecule.
+        Lines aren't added to molecules whose interactions haven't been fetched yet, as they will be on first fetch.
+        """
+        atom_molecules = {}
+        for comp in complexes or []:
+            mol = comp.current_molecule
+            if mol and mol.index in self._lines_by_molecule:
+                for atom in mol.atoms:
+                    atom_molecules[atom.index] = mol.index
+        for line in line_list:
+            self._add_line(line)
+            for atom_index in itertools.chain(line.atom1_idx_arr, line.atom2_idx_arr):
+                molecule_index = atom_molecules.get(atom_index)
+                if molecule_index is not None:
+                    self._lines_by_molecule[molecule_index][id(line)] = line
+
+    def remove(self, line_list):
+        """Remove destroyed lines from the mirror."""
+        for line in line_list:
+            line_id = id(line)
+            self._lines.pop(line_id, None)
+            self._lines_by_kind[line.kind].pop(line_id, None)
+            for atom_index in itertools.chain(line.atom1_idx_arr, line.atom2_idx_arr):
+                self._lines_by_atom[atom_index].pop(line_id, None)
+            for molecule_lines in self._lines_by_molecule.values():
+                molecule_lines.pop(line_id, None)
+
+    def _add_line(self, line):
+        line_id = id(line)
+        self._lines[line_id] = line
+        self._lines_by_kind[line.kind][line_id] = line
+        for atom_index in itertools.chain(line.atom1_idx_arr, line.atom2_idx_arr):
+            self._lines_by_atom[atom_index][line_id] = line
+
+    def _add_fetched_lines(self, fetched_lines):
+        """Add lines fetched from Nanome, reusing our copy of lines we already know about.
+
+        :rtype: list of mirrored lines corresponding to fetched_lines.
+        """
+        lines_by_index = {line.index: line for line in self._lines.values() if line.index >= 0}
+        mirrored_lines = []
+        for line in fetched_lines:
+            known_line = lines_by_index.get(line.index)
+            if known_line is None:
+                self._add_line(line)
+                known_line = lines_by_index[line.index] = line
+            mirrored_lines.append(known_line)
+        return mirrored_lines
+
 
 class InteractionLineManager:
     """Organizes Interaction lines by atom pairs."""
 
+    def __init__(self):
+        self.mirror = InteractionMirror()
+
     async def all_lines(self, **get_kwargs):
-        """Return a flat list of all lines being stored."""
-        all_lines = await Interaction.get(**get_kwargs)
-        return all_lines
+        """Return a flat list of all lines being stored.
 
-    def add_lines(self, line_list):
-        pass
+        Lines are read from the local mirror when possible. Filters other than molecules_idx are sent to Nanome.
+        """
+        molecules_idx = get_kwargs.pop('molecules_idx', None)
+        if get_kwargs:
+            return await Interaction.get(molecules_idx=molecules_idx, **get_kwargs)
+        return await self.mirror.get(molecules_idx)
+
+    def add_lines(self, line_list, complexes=None):
+        """Add uploaded lines to the local mirror.
+
+        complexes: Complexes containing the lines' atoms.
+        """
+        self.mirror.add(line_list, complexes)
 
     def add_line(self, line):
-        pass
+        self.mirror.add([line])
+
+    def invalidate(self):
+        """Fetch lines from Nanome the next time they're requested."""
+        self.mirror.invalidate()
 
     def get_lines_for_structure_pair(self, struct1: InteractionStructure, struct2: InteractionStructure, existing_lines=None):
         """Given two InteractionStructures, return all interaction lines connecting them.
@@ -88,8 +328,8 @@ class InteractionLineManager:
         :arg struct2: InteractionStructure, or index str
         """
         struct_lines = []
-        struct1_atom_indices = [int(x) for x in struct1.index.split(',')]
-        struct2_atom_indices = [int(x) for x in struct2.index.split(',')]
+        struct1_atom_indices = struct1.index
+        struct2_atom_indices = struct2.index
         for line in existing_lines:
             struct1_is_line_atom1 = all(i in line.atom1_idx_arr for i in struct1_atom_indices)
             struct1_is_line_atom2 = all(i in line.atom2_idx_arr for i in struct1_atom_indices)
@@ -112,8 +352,8 @@ class InteractionLineManager:
         return struct_lines
 
     def upload(self, line_list):
-        """Upload multiple lines to Nanome."""
-        Interaction.upload_multiple(line_list)
+        """Upload multiple lines to Nanome. Returns the result of Interaction.upload_multiple."""
+        return Interaction.upload_multiple(line_list)
 
     @staticmethod
     def draw_interaction_line(struct1: InteractionStructure, struct2: InteractionStructure, interaction_kind: enums.InteractionKind, line_settings):
@@ -123,12 +363,8 @@ class InteractionLineManager:
         :arg struct2: struct
         :arg line_settings: Dict describing shape and color of line based on interaction_type
         """
-        struct1_indices = []
-        struct2_indices = []
-        for struct1_index in struct1.index.split(','):
-            struct1_indices.append(int(struct1_index))
-        for struct2_index in struct2.index.split(','):
-            struct2_indices.append(int(struct2_index))
+        struct1_indices = list(struct1.index)
+        struct2_indices = list(struct2.index)
 
         atom1_conformation = struct1.conformer
         atom2_conformation = struct2.conformer
@@ -142,18 +378,23 @@ class InteractionLineManager:
         line.visible = line_settings['visible']
         return line
 
-    async def update_interaction_lines(self, interactions_data, complexes=None, **kwargs):
-        """Update all interaction lines in workspace according to provided colors and visibility settings."""
+    async def update_interaction_lines(self, interactions_data, complexes=None, kinds=None, **kwargs):
+        """Update interaction lines in workspace according to provided colors and visibility settings.
+
+        kinds: list of InteractionKinds whose settings changed. If provided, only lines of those kinds are checked.
+        """
         complexes = complexes or []
-        get_kwargs = {}
+        mol_indices = None
         if complexes:
             mol_indices = [
                 cmp.current_molecule.index
                 for cmp in complexes
                 if cmp.current_molecule is not None
             ]
-            get_kwargs['molecules_idx'] = mol_indices
-        interactions = await self.all_lines(**get_kwargs)
+        interactions = await self.mirror.get(mol_indices)
+        if kinds is not None:
+            interactions = itertools.chain.from_iterable(
+                self.mirror.get_lines_for_kind(kind, mol_indices) for kind in kinds)
         lines_to_update = []
         for line in interactions:
             interaction_type = line.kind.name
@@ -168,34 +409,96 @@ class InteractionLineManager:
         Logs.debug(f'Updating {len(lines_to_update)} lines')
         self.upload(lines_to_update)
 
+    def update_visibility(self, line_list, line_settings):
+        """Set visibility of lines according to line settings, and upload the ones that changed.
+
+        :rtype: list of lines whose visibility changed.
+        """
+        changed_lines = []
+        for line in line_list:
+            kind_settings = line_settings.get(line.kind.name)
+            if kind_settings is not None and line.visible != kind_settings['visible']:
+                line.visible = kind_settings['visible']
+                changed_lines.append(line)
+        if changed_lines:
+            self.upload(changed_lines)
+        return changed_lines
+
     def destroy_lines(self, lines_to_delete):
         Interaction.destroy_multiple(lines_to_delete)
+        self.mirror.remove(lines_to_delete)
+
+
+class LineColorStream:
+    """Writing stream for the colors of a fixed list of lines.
+
+    Streams can't be resized, so the list of lines is fixed when the stream is created.
+    Colors last sent are remembered, so unchanged streams aren't sent again.
+    """
+
+    def __init__(self, stream, lines):
+        self.stream = stream
+        self.lines = lines
+        self.colors = None
+
+    def update(self):
+        """Send current line colors to Nanome, if any have changed. Returns whether an update was sent."""
+        colors = [value for line in self.lines for value in line.color.rgba]
+        if colors == self.colors:
+            return False
+        self.stream.update(colors)
+        self.colors = colors
+        return True
+
+    def destroy(self):
+        try:
+            self.stream.destroy()
+        except KeyError:
+            Logs.warning("Stream not found while destroying.")
 
 
 class ShapesLineManager(StructurePairManager):
     """Organizes Interaction lines by atom pairs."""
 
+    def __init__(self):
+        super().__init__()
+        # Color streams covering uploaded lines, and the stream each line belongs to, by id(line).
+        self._color_streams = []
+        self._color_stream_by_line = {}
+        # Kinds of the lines stored for each structpair key.
+        self._kinds = defaultdict(set)
+        # (structpair key, position in self._data[structpair key]) of each line, by id(line).
+        self._line_slots = {}
+        # id(line) for uploaded lines, by shape index.
+        self._line_ids_by_index = {}
+        # {id(line): line} for each InteractionKind.
+        self._lines_by_kind = defaultdict(dict)
+
     async def all_lines(self, **kwargs):
         """Return a flat list of all lines being stored."""
-        all_lines = []
-        for _, line_list in sorted(self._data.items(), key=lambda keyval: keyval[0]):
-            all_lines.extend(line_list)
-        return all_lines
+        return list(itertools.chain.from_iterable(self._data.values()))
 
-    def add_lines(self, line_list):
+    def add_lines(self, line_list, complexes=None):
+        """Add lines to manager. complexes is unused, as all lines are stored locally."""
         for line in line_list:
             self.add_line(line)
 
+    def invalidate(self):
+        """Lines are only stored locally, so there's nothing to fetch again."""
+        pass
+
     def add_line(self, line):
         if not isinstance(line, InteractionShapesLine):
             raise TypeError(f'add_line() expected InteractionLine, received {type(line)}')
 
         structpair_key = self.get_structpair_key_for_line(line)
-        existing_interaction_kinds = [ln.kind for ln in self._data[structpair_key]]
-        if line.kind not in existing_interaction_kinds:
-            self._data[structpair_key].append(line)
-            # Clear stream now that the line list is changing
-            self._destroy_stream()
+        if line.kind not in self._kinds[structpair_key]:
+            # New lines are picked up by a new color stream on the next update.
+            line_list = self._data[structpair_key]
+            self._line_slots[id(line)] = (structpair_key, len(line_list))
+            line_list.append(line)
+            self._kinds[structpair_key].add(line.kind)
+            self._lines_by_kind[line.kind][id(line)] = line
 
     def get_lines_for_structure_pair(self, struct1: InteractionStructure, struct2: InteractionStructure, *args, **kwargs):
         """Given two InteractionStructures, return all interaction lines connecting them.
@@ -207,8 +510,8 @@ class ShapesLineManager(StructurePairManager):
         return self._data[key]
 
     def upload(self, line_list):
-        """Upload multiple lines to Nanome."""
-        Shape.upload_multiple(line_list)
+        """Upload multiple lines to Nanome. Returns the result of Shape.upload_multiple."""
+        return Shape.upload_multiple(line_list)
 
     @staticmethod
     def draw_interaction_line(
@@ -231,75 +534,210 @@ class ShapesLineManager(StructurePairManager):
             anchor.local_offset = struct.calculate_local_offset()
         return line
 
-    async def update_interaction_lines(self, interactions_data, complexes=None, plugin=None):
+    def get_lines_for_kind(self, kind):
+        """Return all lines of the provided InteractionKind."""
+        return list(self._lines_by_kind[kind].values())
+
+    async def update_interaction_lines(self, interactions_data, complexes=None, plugin=None, kinds=None):
+        """Update line colors according to provided colors and visibility settings.
+
+        kinds: list of InteractionKinds whose settings changed. If provided, only lines of those kinds are updated.
+        """
         complexes = complexes or []
-        stream_type = enums.StreamType.shape_color.value
         if not complexes:
             Logs.warning("No complexes to update, returning")
             return
-        all_lines = await self.all_lines()
-        line_indices = [line.index for line in all_lines]
-        if not line_indices:
+        if kinds is None:
+            all_lines = await self.all_lines()
+        else:
+            all_lines = list(itertools.chain.from_iterable(self.get_lines_for_kind(kind) for kind in kinds))
+        if not all_lines:
             Logs.warning("No interaction lines to update, returning")
             return
-        if not getattr(self, '_stream', False):
-            Logs.debug("Recreating Stream.")
-            self._stream, _ = await plugin.create_writing_stream(line_indices, stream_type)
-            if not self._stream:
-                Logs.error("Failed to Create stream.")
-                return
-        new_colors = []
-        in_frame_count = 0
-        out_of_frame_count = 0
-
-        for line in all_lines:
-            # Make sure that both atoms connected by line are in frame.
-            atom_iter = itertools.chain.from_iterable(cmp.current_molecule.atoms for cmp in complexes if cmp.current_molecule)
-            line_is_in_frame = utils.line_in_frame(line, atom_iter)
-            if line_is_in_frame:
-                in_frame_count += 1
-            else:
-                out_of_frame_count += 1
+        await self._ensure_color_streams(all_lines, plugin)
 
-            # Parse forms, and add line data to stream
+        # Make sure that both atoms connected by each line are in frame.
+        lines_in_frame = utils.ConformerMap(complexes).in_frame_mask(all_lines).tolist()
+        for line, line_is_in_frame in zip(all_lines, lines_in_frame):
+            # Parse forms, and update line color
             line_type = line.kind.name
             form_data = interactions_data[line_type]
             hide_interaction = not form_data['visible'] or not line_is_in_frame
             color = Color(*form_data['color'])
-
             color.a = 0 if hide_interaction else 255
-            new_colors.extend(color.rgba)
             line.color = color
-            self._update_line(line)
 
-        # Logs.debug(f'in frame: {in_frame_count}')
-        # Logs.debug(f'out of frame: {out_of_frame_count}')
-        if self._stream:
-            self._stream.update(new_colors)
+        # Only streams containing lines whose color changed are sent.
+        if kinds is None:
+            color_streams = self._color_streams
+        else:
+            color_streams = self._get_color_streams_for_lines(all_lines)
+        updated_stream_count = sum(color_stream.update() for color_stream in color_streams)
+        Logs.debug(f'Updated {updated_stream_count} / {len(self._color_streams)} color streams')
+
+    def update_visibility(self, line_list, line_settings):
+        """Show or hide lines according to line settings, sending only the ones that changed.
+
+        Lines covered by a color stream are updated through it, others are uploaded again.
+        :rtype: list of lines whose visibility changed.
+        """
+        changed_lines = []
+        for line in line_list:
+            kind_settings = line_settings.get(line.kind.name)
+            if kind_settings is None:
+                continue
+            alpha = 255 if kind_settings['visible'] else 0
+            if line.color.a != alpha:
+                line.color.a = alpha
+                changed_lines.append(line)
+        for color_stream in self._get_color_streams_for_lines(changed_lines):
+            color_stream.update()
+        unstreamed_lines = [line for line in changed_lines if id(line) not in self._color_stream_by_line]
+        if unstreamed_lines:
+            self.upload(unstreamed_lines)
+        return changed_lines
+
+    async def _ensure_color_streams(self, all_lines, plugin):
+        """Create a color stream for uploaded lines not covered by an existing stream."""
+        unstreamed_lines = [
+            line for line in all_lines
+            if id(line) not in self._color_stream_by_line and line.index >= 0
+        ]
+        if not unstreamed_lines:
+            return
+        Logs.debug(f"Creating color stream for {len(unstreamed_lines)} lines.")
+        stream_type = enums.StreamType.shape_color.value
+        line_indices = [line.index for line in unstreamed_lines]
+        stream, _ = await plugin.create_writing_stream(line_indices, stream_type)
+        if not stream:
+            Logs.error("Failed to Create stream.")
+            return
+        color_stream = LineColorStream(stream, unstreamed_lines)
+        self._color_streams.append(color_stream)
+        for line in unstreamed_lines:
+            self._color_stream_by_line[id(line)] = color_stream
+            self._line_ids_by_index[line.index] = id(line)
 
     def destroy_lines(self, lines_to_delete):
         Shape.destroy_multiple(lines_to_delete)
         for line in lines_to_delete:
-            structpair_key = self.get_structpair_key_for_line(line)
-            if structpair_key in self._data:
-                self._data[structpair_key].remove(line)
+            if id(line) in self._line_slots:
+                self._remove_line(line)
             else:
                 Logs.warning("Line not found in manager while deleting.")
-
-    def _destroy_stream(self):
-        if getattr(self, '_stream', False):
-            try:
-                self._stream.destroy()
-                del self._stream
-            except KeyError:
-                Logs.warning("Stream not found while destroying.")
-                pass
+        # Destroy streams containing deleted lines.
+        # Their remaining lines are added to a new stream on the next update.
+        for color_stream in self._get_color_streams_for_lines(lines_to_delete):
+            self._destroy_color_stream(color_stream)
+
+    def _get_color_streams_for_lines(self, line_list):
+        """Return list of color streams containing any of the lines."""
+        color_streams = {}
+        for line in line_list:
+            color_stream = self._color_stream_by_line.get(id(line))
+            if color_stream:
+                color_streams[id(color_stream)] = color_stream
+        return list(color_streams.values())
+
+    def _destroy_color_stream(self, color_stream):
+        color_stream.destroy()
+        self._color_streams.remove(color_stream)
+        for line in color_stream.lines:
+            self._color_stream_by_line.pop(id(line), None)
+
+    def _remove_line(self, line):
+        """Remove line from manager, moving the last line of its structure pair into its slot."""
+        structpair_key, slot = self._line_slots.pop(id(line))
+        line_list = self._data[structpair_key]
+        last_line = line_list.pop()
+        if last_line is not line:
+            line_list[slot] = last_line
+            self._line_slots[id(last_line)] = (structpair_key, slot)
+        self._kinds[structpair_key].discard(line.kind)
+        self._lines_by_kind[line.kind].pop(id(line), None)
+        if self._line_ids_by_index.get(line.index) == id(line):
+            del self._line_ids_by_index[line.index]
 
     def _update_line(self, line):
-        """Replace line stored in manager with updated version passed as arg."""
-        structpair_key = self.get_structpair_key(*line.structure_indices)
+        """Replace line stored in manager with updated version passed as arg.
+
+        The stored line is found by identity, or by shape index if line is a different object.
+        """
+        line_id = id(line) if id(line) in self._line_slots else self._line_ids_by_index.get(line.index)
+        if line_id is None:
+            Logs.warning("Line not found in manager while updating.")
+            return
+        structpair_key, slot = self._line_slots.pop(line_id)
         line_list = self._data[structpair_key]
-        for i, stored_line in enumerate(line_list):
-            if stored_line.index == line.index:
-                line_list[i] = line
-                break
+        for kind_lines in self._lines_by_kind.values():
+            kind_lines.pop(line_id, None)
+        self._lines_by_kind[line.kind][id(line)] = line
+        line_list[slot] = line
+        self._line_slots[id(line)] = (structpair_key, slot)
+        if line.index >= 0:
+            self._line_ids_by_index[line.index] = id(line)
+        # The line's kind may have changed, so the pair's kinds are collected again.
+        self._kinds[structpair_key] = {ln.kind for ln in line_list}
+
+
+class LineUploader:
+    """Upload lines to Nanome in fixed size chunks, while they are still being created.
+
+    Lines are buffered until a full chunk is available, and each chunk is uploaded as soon as it's full.
+    Chunks are added to the line manager once Nanome acknowledges them, so lines have their indices
+    and can be matched against lines fetched from the workspace. At most max_pending_uploads chunks
+    are awaiting acknowledgement from Nanome at a time; once the limit is reached, add() waits for the oldest one.
+    """
+
+    def __init__(self, line_manager, chunk_size=5000, max_pending_uploads=4, complexes=None, progress=None):
+        self.line_manager = line_manager
+        self.chunk_size = max(chunk_size, 1)
+        self.max_pending_uploads = max(max_pending_uploads, 1)
+        self.complexes = complexes
+        self.progress = progress
+        self.uploaded_lines = []
+        self._buffer = []
+        self._pending_uploads = deque()
+
+    async def add(self, line_list):
+        """Queue lines for upload, sending every full chunk."""
+        self._buffer.extend(line_list)
+        if self.progress:
+            self.progress.set_total('upload', len(self.uploaded_lines) + len(self._buffer))
+        while len(self._buffer) >= self.chunk_size:
+            chunk = self._buffer[:self.chunk_size]
+            del self._buffer[:self.chunk_size]
+            await self._send(chunk)
+
+    async def flush(self):
+        """Send remaining buffered lines, and wait for all uploads to be acknowledged."""
+        if self._buffer:
+            chunk = self._buffer
+            self._buffer = []
+            await self._send(chunk)
+        while self._pending_uploads:
+            await self._wait_for_oldest()
+
+    async def _send(self, chunk):
+        while len(self._pending_uploads) >= self.max_pending_uploads:
+            await self._wait_for_oldest()
+        result = self.line_manager.upload(chunk)
+        self.uploaded_lines.extend(chunk)
+        if not asyncio.isfuture(result):
+            # Nothing to wait for (e.g upload was mocked, or plugin isn't running async)
+            self._add_uploaded(chunk)
+            return
+        self._pending_uploads.append((chunk, result))
+
+    async def _wait_for_oldest(self):
+        chunk, fut = self._pending_uploads.popleft()
+        await fut
+        self._add_uploaded(chunk)
+
+    def _add_uploaded(self, chunk):
+        self.line_manager.add_lines(chunk, self.complexes)
+        self._advance_progress(len(chunk))
+
+    def _advance_progress(self, count):
+        if self.progress:
+            self.progress.advance('upload', count)
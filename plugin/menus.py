@@ -185,23 +185,27 @@ class ChemInteractionsMenu():
         btn.text.value.set_all(btn_text)
 
         # Show default values
+        changed_kinds = []
         for row in self.ls_interactions.items:
             content = [ch.get_content() for ch in row.get_children()]
             btn = next(c for c in content if isinstance(c, Button))
+            lbl_interaction_type = next(c for c in content if isinstance(c, Label))
+            interaction_type = lbl_interaction_type.field_name
 
             if new_state == default_state:
                 # If resetting to default state, lookup visibility from default_line_settings
-                lbl_interaction_type = next(c for c in content if isinstance(c, Label))
-                interaction_type = lbl_interaction_type.field_name
                 selected_value = default_line_settings[interaction_type]['visible']
             else:
                 # Show all and hide all states will always be True or False respectively
                 selected_value = new_state == show_all_state
 
+            if btn.selected != selected_value:
+                changed_kinds.append(enums.InteractionKind[interaction_type])
             btn.selected = selected_value
 
         self.plugin.update_menu(self._menu)
-        await self.update_interaction_lines()
+        # Only lines of kinds whose visibility changed need to be updated.
+        await self.update_interaction_lines(kinds=changed_kinds)
 
     @async_callback
     async def clear_frame(self, btn):
@@ -430,20 +434,22 @@ class ChemInteractionsMenu():
     async def toggle_visibility(self, btn):
         btn.selected = not btn.selected
         self.plugin.update_content(btn)
-        await self.update_interaction_lines()
-        # Log the interaction being toggled
+        # Find the interaction being toggled, so only its lines are updated.
+        kinds = None
         for item in self.ls_interactions.items:
             item_btn = item.get_children()[0].get_content()
             if item_btn._content_id == btn._content_id:
                 item_lbl = item.get_children()[1].get_content()
+                kinds = [enums.InteractionKind[item_lbl.field_name]]
                 interaction_type = item_lbl.text_value
                 Logs.message(f"{'Showing' if btn.selected else 'Hiding'} {interaction_type} interactions")
                 break
+        await self.update_interaction_lines(kinds=kinds)
 
     @async_callback
-    async def update_interaction_lines(self):
+    async def update_interaction_lines(self, kinds=None):
         interaction_data = self.collect_interaction_data()
-        await self.plugin.update_interaction_lines(interaction_data, self.complexes)
+        await self.plugin.update_interaction_lines(interaction_data, self.complexes, kinds=kinds)
 
     @property
     def index(self):
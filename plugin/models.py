@@ -1,3 +1,4 @@
+from collections import defaultdict
 from operator import attrgetter
 
 from nanome.api.shapes import Line
@@ -5,69 +6,154 @@ from nanome.api.structure import Atom
 from nanome.util import Vector3, Logs
 
 
+class AtomNotFoundException(Exception):
+    pass
+
+
+class AtomPathIndex:
+    """Lookup table for resolving Arpeggio atom paths (e.g C/20/O) to Atoms.
+
+    Atoms in the current molecule of each complex are keyed by (chain name, residue serial, atom name),
+    so the table only needs to be built once per run, and each lookup is a dict access.
+    atom_owners maps each atom index to (complex, frame, conformer) of the complex containing it.
+    """
+
+    def __init__(self, complexes):
+        self.complexes = list(complexes)
+        self._atom_maps = [self.build_atom_map(comp) for comp in self.complexes]
+        self.atoms_by_index = {}
+        self.atom_owners = {}
+        for comp, atom_map in zip(self.complexes, self._atom_maps):
+            owner = (comp, comp.current_frame, comp.current_conformer)
+            for atoms in atom_map.values():
+                for atom in atoms:
+                    self.atoms_by_index[atom.index] = atom
+                    self.atom_owners[atom.index] = owner
+
+    @staticmethod
+    def build_atom_map(comp):
+        """Map (chain name, residue serial, atom name) to list of matching atoms in comp's current molecule."""
+        atom_map = defaultdict(list)
+        comp_mol = comp.current_molecule
+        if not comp_mol:
+            return atom_map
+        for atom in comp_mol.atoms:
+            key = (atom.chain.name, str(atom.residue.serial), atom.name)
+            atom_map[key].append(atom)
+        return atom_map
+
+    def get_atom(self, atom_path):
+        """Return atom corresponding to atom path, checking complexes in order.
+
+        :arg atom_path: str (e.g C/20/O)
+        rtype: nanome.api.Atom object, or None
+        """
+        for atom_map in self._atom_maps:
+            atom = self._get_atom_from_map(atom_map, atom_path)
+            if atom is not None:
+                return atom
+
+    @staticmethod
+    def _get_atom_from_map(atom_map, atom_path):
+        chain_name, res_id, atom_name = atom_path.split('/')
+        # Chain naming seems inconsistent, so we need to check the provided name,
+        # as well as heteroatom variation
+        exact_atoms = atom_map.get((chain_name, res_id, atom_name), [])
+        het_atoms = atom_map.get((f'H{chain_name}', res_id, atom_name), [])
+        atom_count = len(exact_atoms) + len(het_atoms)
+        if atom_count == 0:
+            return
+
+        if atom_count > 1:
+            # If multiple atoms found, check exact matches (no heteroatoms)
+            if not exact_atoms:
+                msg = f"Error finding atom {atom_path}. Please ensure atoms are uniquely named."
+                Logs.warning(msg)
+                raise AtomNotFoundException(msg)
+
+            if len(exact_atoms) > 1:
+                # Just pick the first one? :grimace:
+                Logs.debug(f'Too many Atoms found for {atom_path}')
+            return exact_atoms[0]
+        return (exact_atoms or het_atoms)[0]
+
+
+class AtomTable:
+    """Picklable, lightweight version of an AtomPathIndex, for resolving atom paths in worker processes.
+
+    Stores atom indices instead of Atom objects, along with the frame, conformer
+    and selection state of each atom.
+    """
+
+    def __init__(self, atom_index: AtomPathIndex):
+        self._atom_maps = []
+        self.atom_data = {}
+        for atom_map in atom_index._atom_maps:
+            self._atom_maps.append({
+                key: [atom.index for atom in atoms]
+                for key, atoms in atom_map.items()
+            })
+        for index, (_, frame, conformer) in atom_index.atom_owners.items():
+            self.atom_data[index] = (frame, conformer, atom_index.atoms_by_index[index].selected)
+
+    def get_atom_index(self, atom_path):
+        """Return index of atom corresponding to atom path, or None."""
+        for atom_map in self._atom_maps:
+            atom_index = AtomPathIndex._get_atom_from_map(atom_map, atom_path)
+            if atom_index is not None:
+                return atom_index
+
+
 class InteractionStructure:
     """Abstraction representing one end of a chemical interaction.
 
     Is either a single Atom, or a ring of atoms.
+    The index and line anchor are computed once on creation, and the centroid on first access,
+    so structures should be recreated if their atoms change.
     """
 
-    # Records the frame and conformer of the complex that the Structure is a part of.
-    frame = None
-    conformer = None
+    __slots__ = ('atoms', 'frame', 'conformer', 'index', 'line_anchor', '_centroid')
 
     def __init__(self, atom_or_atoms):
         """Pass in either a single Atom object or a list of Atoms."""
-        frame = None
-        conformer = None
         if isinstance(atom_or_atoms, Atom):
-            self.atoms.append(atom_or_atoms)
-            frame = atom_or_atoms.complex.current_frame
-            conformer = atom_or_atoms.molecule.current_conformer
-        elif isinstance(atom_or_atoms, list):
-            self.atoms.extend(atom_or_atoms)
-            atom = atom_or_atoms[0]
-            frame = atom.complex.current_frame
-            conformer = atom.molecule.current_conformer
-        self.frame = frame
-        self.conformer = conformer
-
-    @property
-    def atoms(self):
-        if not hasattr(self, '_atoms'):
-            self._atoms = []
-        return self._atoms
-
-    @property
-    def line_anchor(self):
-        """Arbitrary atom in structure, but consistent."""
-        return next(iter(sorted(self.atoms, key=attrgetter('index'))))
-
-    @property
-    def index(self):
-        """Unique index based on atoms in structure and their positions.
-        examples
-        single atom structure -> '5432591673'
-        ring structures -> '5432591673,75462591674,943234535'
-        """
-        atom_strs = []
-        for a in sorted(self.atoms, key=attrgetter('index')):
-            atom_strs.append(str(a.index))
-        index = ','.join(atom_strs)
-        return index
+            atoms = [atom_or_atoms]
+        else:
+            atoms = list(atom_or_atoms)
+        self.atoms = atoms
+        # Records the frame and conformer of the complex that the Structure is a part of.
+        self.frame = None
+        self.conformer = None
+        self._centroid = None
+        sorted_atoms = sorted(atoms, key=attrgetter('index'))
+        # Unique index based on atoms in structure.
+        # single atom structure -> (5432591673,)
+        # ring structures -> (5432591673, 7546259167, 9432345350)
+        self.index = tuple(a.index for a in sorted_atoms)
+        # Arbitrary atom in structure, but consistent.
+        self.line_anchor = sorted_atoms[0] if sorted_atoms else None
+        if atoms:
+            self.frame = atoms[0].complex.current_frame
+            self.conformer = atoms[0].molecule.current_conformer
 
     @property
     def centroid(self):
-        """Calculate center of the structure."""
-        coords = [a.position.unpack() for a in self.atoms]
-        sum_x = sum([vec[0] for vec in coords])
-        sum_y = sum([vec[1] for vec in coords])
-        sum_z = sum([vec[2] for vec in coords])
-        len_coord = len(coords)
-        centroid = Vector3(sum_x / len_coord, sum_y / len_coord, sum_z / len_coord)
-        return centroid
+        """Center of the structure."""
+        if self._centroid is None:
+            len_coord = len(self.atoms)
+            sum_x = sum_y = sum_z = 0
+            for atom in self.atoms:
+                x, y, z = atom.position.unpack()
+                sum_x += x
+                sum_y += y
+                sum_z += z
+            self._centroid = Vector3(sum_x / len_coord, sum_y / len_coord, sum_z / len_coord)
+        return self._centroid
 
     def calculate_local_offset(self):
         """Calculate offset to move line anchor to center of ring."""
+        if len(self.atoms) == 1:
+            return Vector3(0, 0, 0)
         ring_center = self.centroid
         anchor_position = self.line_anchor.position
         offset_vector = Vector3(
@@ -79,11 +165,21 @@ class InteractionStructure:
 
 
 class InteractionShapesLine(Line):
-    """A Line with additional properties needed for representing interactions."""
+    """A Line with additional properties needed for representing interactions.
+
+    Frame, conformer, and last known position are stored for each end of the line,
+    atom1 being struct1 and atom2 being struct2, to match the Interaction API.
+    """
+
+    __slots__ = (
+        'kind', 'atom1_idx_arr', 'atom2_idx_arr', 'struct1_index', 'struct2_index',
+        'atom1_frame', 'atom2_frame', 'atom1_conformation', 'atom2_conformation',
+        'atom1_position', 'atom2_position')
 
     def __init__(self, struct1, struct2, **kwargs):
         super().__init__()
-
+        # The type of interaction this line is representing. See forms.LineSettingsForm for valid values.
+        self.kind = ''
         for kwarg, value in kwargs.items():
             if hasattr(self, kwarg):
                 setattr(self, kwarg, value)
@@ -91,63 +187,31 @@ class InteractionShapesLine(Line):
         if kwargs.get('visible') is False:
             self.color.a = 0
 
-        # Set up frames, conformers, and positions dict.
-        for struct in [struct1, struct2]:
-            struct_position = struct.line_anchor.position
-            self.frames[struct.index] = struct.frame
-            self.conformers[struct.index] = struct.conformer
-            self.struct_positions[struct.index] = struct_position
+        self.struct1_index = struct1.index
+        self.struct2_index = struct2.index
+        self.atom1_frame = struct1.frame
+        self.atom2_frame = struct2.frame
+        self.atom1_conformation = struct1.conformer
+        self.atom2_conformation = struct2.conformer
+        # Last known position of the line anchor of each structure.
+        self.atom1_position = struct1.line_anchor.position
+        self.atom2_position = struct2.line_anchor.position
         # Save atom_indices to be interchangeable with Interaction objects
         self.atom1_idx_arr = [atm.index for atm in struct1.atoms]
         self.atom2_idx_arr = [atm.index for atm in struct2.atoms]
 
-    @property
-    def kind(self):
-        """The type of interaction this line is representing. See forms.LineSettingsForm for valid values."""
-        if not hasattr(self, '_kind'):
-            self._kind = ''
-        return self._kind
-
-    @kind.setter
-    def kind(self, value):
-        self._kind = value
-
-    @property
-    def frames(self):
-        """Dict where key is structure index and value is current frame of the atom's complex."""
-        if not hasattr(self, '_frames'):
-            self._frames = {}
-        return self._frames
-
-    @property
-    def conformers(self):
-        """Dict where key is structure index and value is current conformer of the atom's molecule."""
-        if not hasattr(self, '_conformers'):
-            self._conformers = {}
-        return self._conformers
-
-    @property
-    def struct_positions(self):
-        """Dict where key is structure index and value is last known (x, y, z) coordinates of Structure."""
-        if not hasattr(self, '_struct_positions'):
-            self._struct_positions = {}
-        return self._struct_positions
-
     @property
     def length(self):
         """Determine length of line using the distance between the structures."""
-        positions = []
-        for anchor in self.anchors:
-            struct_key = next(struc_key for struc_key in self.structure_indices if str(anchor.target) in struc_key)
-            position = self.struct_positions[struct_key] + anchor.local_offset
-            positions.append(position)
-        distance = Vector3.distance(*positions)
-        return distance
+        anchor1, anchor2 = self.anchors
+        position1 = self.atom1_position + anchor1.local_offset
+        position2 = self.atom2_position + anchor2.local_offset
+        return Vector3.distance(position1, position2)
 
     @property
     def structure_indices(self):
-        """Return a list of struture indices."""
-        return self.frames.keys()
+        """Return the indices of the two structures connected by the line."""
+        return (self.struct1_index, self.struct2_index)
 
     @property
     def visible(self):
@@ -159,23 +223,3 @@ class InteractionShapesLine(Line):
             self.color.a = 1
         else:
             self.color.a = 0
-
-    @property
-    def atom1_conformation(self):
-        """Return the conformer of the atom in the second structure."""
-        try:
-            atom_index = str(self.atom1_idx_arr[0])
-            conformer_key = next(key for key in self.conformers.keys() if str(atom_index) in key)
-            return self.conformers[conformer_key]
-        except IndexError:
-            Logs.warning("atom1_idx_arr is empty")
-
-    @property
-    def atom2_conformation(self):
-        """Return the conformer of the atom in the second structure."""
-        try:
-            atom_index = str(self.atom2_idx_arr[0])
-            conformer_key = next(key for key in self.conformers.keys() if str(atom_index) in key)
-            return self.conformers[conformer_key]
-        except IndexError:
-            Logs.warning("atom2_idx_arr is empty")
@@ -1,5 +1,8 @@
 import itertools
+import threading
 import time
+from collections import defaultdict
+import numpy as np
 from nanome.api import structure
 from nanome.api.interactions import Interaction
 from nanome.util import ComplexUtils, Vector3, Logs
@@ -9,7 +12,10 @@ from .models import InteractionShapesLine
 from typing import Union, List
 
 
-__all__ = ['chunks', 'extract_residues_from_complex', 'merge_complexes', 'get_neighboring_atoms', 'interaction_type_map']
+__all__ = [
+    'ConformerMap', 'ProgressTracker', 'chunks', 'extract_residues_from_complex', 'merge_complexes',
+    'get_neighboring_atoms', 'interaction_type_map'
+]
 
 
 def extract_residues_from_complex(comp, residue_list, comp_name=None):
@@ -92,6 +98,88 @@ def merge_complexes(complexes, align_reference, selected_atoms_only=False):
     return merged_complex
 
 
+class ProgressTracker:
+    """Aggregate progress of a calculation across stages and worker threads.
+
+    Each stage has a weight, describing its share of the loading bar, and a total amount of work.
+    Workers report completed work with `advance`, which is safe to call from any thread.
+    update_fn(current, total) is called at most max_updates_per_second times,
+    so workers don't flood the menu with loading bar updates.
+    """
+
+    def __init__(self, update_fn, stage_weights=None, max_updates_per_second=4):
+        self.update_fn = update_fn
+        self.min_update_interval = 1 / max_updates_per_second
+        self._lock = threading.Lock()
+        self.reset(stage_weights)
+
+    def reset(self, stage_weights=None):
+        """Start tracking a new calculation, with the provided {stage: weight} dict.
+
+        Work reported for stages without a weight is counted, but doesn't move the loading bar.
+        """
+        with self._lock:
+            self.stage_weights = dict(stage_weights or {})
+            self.stage_totals = defaultdict(int)
+            self.stage_counts = defaultdict(int)
+            self._last_update_time = 0
+
+    def set_total(self, stage, total):
+        """Set amount of work in stage. Can be updated as estimates improve."""
+        with self._lock:
+            self.stage_totals[stage] = total
+            fraction = self._pop_update()
+        self._send_update(fraction)
+
+    def advance(self, stage, count=1):
+        """Record count units of completed work in stage."""
+        with self._lock:
+            self.stage_counts[stage] += count
+            fraction = self._pop_update()
+        self._send_update(fraction)
+
+    def complete(self, stage):
+        """Mark all work in stage as completed.
+
+        Always sends an update, so the final state of the loading bar isn't dropped by the throttle.
+        """
+        with self._lock:
+            self.stage_totals[stage] = self.stage_counts[stage] = max(self.stage_totals[stage], 1)
+            self._last_update_time = time.monotonic()
+            fraction = self._fraction()
+        self._send_update(fraction)
+
+    @property
+    def fraction(self):
+        """Weighted fraction of work completed across all stages."""
+        with self._lock:
+            return self._fraction()
+
+    def _fraction(self):
+        total_weight = sum(self.stage_weights.values())
+        if not total_weight:
+            return 0.0
+        completed = 0.0
+        for stage, weight in self.stage_weights.items():
+            total = self.stage_totals[stage]
+            if total:
+                completed += weight * min(self.stage_counts[stage] / total, 1.0)
+        return completed / total_weight
+
+    def _pop_update(self):
+        """Return current fraction if an update is due, otherwise None. Must be called with lock held."""
+        now = time.monotonic()
+        if now - self._last_update_time < self.min_update_interval:
+            return
+        self._last_update_time = now
+        return self._fraction()
+
+    def _send_update(self, fraction):
+        # update_fn is called outside the lock, so slow updates don't block workers.
+        if fraction is not None:
+            self.update_fn(fraction, 1)
+
+
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
@@ -134,55 +222,126 @@ def centroid(atoms):
     return centroid
 
 
-def calculate_interaction_length(line: Interaction, complexes):
-    """Determine length of line using the distance between the structures."""
-    all_atoms = itertools.chain(*[comp.atoms for comp in complexes])
-    struct1_atoms = []
-    struct2_atoms = []
-    for atom in all_atoms:
-        if atom.index in line.atom1_idx_arr:
-            struct1_atoms.append(atom)
-        if atom.index in line.atom2_idx_arr:
-            struct2_atoms.append(atom)
-    struct1_centroid = centroid(struct1_atoms)
-    struct2_centroid = centroid(struct2_atoms)
-    distance = Vector3.distance(struct1_centroid, struct2_centroid)
-    return distance
+def calculate_interaction_lengths(line_list: List[Union[Interaction, InteractionShapesLine]], complexes):
+    """Determine length of each line using the distance between the centroids of its structures.
+
+    Atom positions are gathered into one array per molecule, and the centroids and distances
+    of all lines are computed in a few vectorized operations.
+    :rtype: numpy array of distances, aligned with line_list. nan if a structure's atoms weren't found.
+    """
+    atom_indices = []
+    atom_positions = []
+    for comp in complexes:
+        for mol in comp.molecules:
+            mol_atoms = list(mol.atoms)
+            atom_indices.append(np.fromiter((atom.index for atom in mol_atoms), dtype=np.int64, count=len(mol_atoms)))
+            atom_positions.append(np.array([atom.position.unpack() for atom in mol_atoms], dtype=np.float64).reshape(-1, 3))
+    atom_indices = np.concatenate(atom_indices) if atom_indices else np.empty(0, dtype=np.int64)
+    atom_positions = np.concatenate(atom_positions) if atom_positions else np.empty((0, 3))
+    order = np.argsort(atom_indices)
+    sorted_indices = atom_indices[order]
+    sorted_positions = atom_positions[order]
+
+    line_count = len(line_list)
+    centroids = []
+    for idx_arr_attr in ['atom1_idx_arr', 'atom2_idx_arr']:
+        flat_indices, owners = _flatten_index_arrays([getattr(line, idx_arr_attr) for line in line_list])
+        positions, found = _search_sorted(sorted_indices, flat_indices)
+        sums = np.zeros((line_count, 3))
+        np.add.at(sums, owners[found], sorted_positions[positions[found]])
+        counts = np.bincount(owners[found], minlength=line_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids.append(sums / counts[:, np.newaxis])
+    struct1_centroids, struct2_centroids = centroids
+    return np.linalg.norm(struct1_centroids - struct2_centroids, axis=1)
+
+
+def _flatten_index_arrays(idx_arrs):
+    """Flatten list of atom index lists into one array, along with the position of the list each index came from."""
+    lengths = np.fromiter((len(arr) for arr in idx_arrs), dtype=np.int64, count=len(idx_arrs))
+    flat_indices = np.fromiter(itertools.chain.from_iterable(idx_arrs), dtype=np.int64, count=int(lengths.sum()))
+    owners = np.repeat(np.arange(len(idx_arrs)), lengths)
+    return flat_indices, owners
+
 
+def _search_sorted(sorted_indices, values):
+    """Return position of each value in sorted_indices, and boolean array marking the values that were found."""
+    if not len(sorted_indices):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_indices, values)
+    positions[positions == len(sorted_indices)] = 0
+    found = sorted_indices[positions] == values
+    return positions, found
 
-def line_in_frame(line: Union[Interaction, InteractionShapesLine], atom_iter):
-    """Return boolean stating whether both structures connected by line are in frame.
 
-    :arg line: Line object. The line in question.
-    :arg complexes: List of complexes in workspace that can contain atoms.
+class ConformerMap:
+    """Map from atom index to the current conformer of its molecule, for atoms in the current frame.
+
+    Built once from the workspace, so any number of lines can be checked against it
+    without walking the complexes again. Atom indices are stored in a sorted array,
+    so lookups can be vectorized.
     """
-    # Find the atoms from the comp by their id, and make sure  they're in the same conformer.
-    atom1_in_frame = None
-    atom2_in_frame = None
-    for atom in atom_iter:
-        atom_conformer = atom.molecule.current_conformer
-        if atom.index in line.atom1_idx_arr:
-            atom1_in_frame = atom_conformer == line.atom1_conformation
-        elif atom.index in line.atom2_idx_arr:
-            atom2_in_frame = atom_conformer == line.atom2_conformation
-        if atom1_in_frame is not None and atom2_in_frame is not None:
-            break
-    line_in_frame = atom1_in_frame and atom2_in_frame
-    return line_in_frame
+
+    # Placeholder conformers, for atoms that aren't in frame and lines with no conformer set.
+    MISSING = -1
+    UNSET = -2
+
+    def __init__(self, complexes):
+        conformers_by_atom = {}
+        for comp in complexes:
+            mol = comp.current_molecule
+            if not mol:
+                continue
+            conformer = mol.current_conformer
+            for atom in mol.atoms:
+                conformers_by_atom[atom.index] = conformer
+        atom_count = len(conformers_by_atom)
+        atom_indices = np.fromiter(conformers_by_atom.keys(), dtype=np.int64, count=atom_count)
+        conformers = np.fromiter(conformers_by_atom.values(), dtype=np.int64, count=atom_count)
+        order = np.argsort(atom_indices)
+        self._sorted_indices = atom_indices[order]
+        self._sorted_conformers = conformers[order]
+
+    def in_frame_mask(self, line_list: List[Union[Interaction, InteractionShapesLine]]):
+        """Return boolean array marking the lines whose structures are both in frame.
+
+        Atom indices of all lines are flattened, and looked up in a single vectorized pass.
+        """
+        line_count = len(line_list)
+        mask = np.ones(line_count, dtype=bool)
+        if not line_count:
+            return mask
+        for idx_arr_attr, conformation_attr in [
+                ('atom1_idx_arr', 'atom1_conformation'), ('atom2_idx_arr', 'atom2_conformation')]:
+            idx_arrs = [getattr(line, idx_arr_attr) for line in line_list]
+            expected_conformers = np.fromiter((
+                self.UNSET if conformer is None else conformer
+                for conformer in (getattr(line, conformation_attr) for line in line_list)
+            ), dtype=np.int64, count=line_count)
+            mask &= self._current_conformers(idx_arrs) == expected_conformers
+        return mask
+
+    def lines_in_frame(self, line_list: List[Union[Interaction, InteractionShapesLine]]):
+        """Return list of lines whose structures are both in frame."""
+        mask = self.in_frame_mask(line_list)
+        return [line for line, in_frame in zip(line_list, mask.tolist()) if in_frame]
+
+    def _current_conformers(self, idx_arrs):
+        """Return array with the current conformer of each structure, or MISSING if it's not in frame."""
+        flat_indices, owners = _flatten_index_arrays(idx_arrs)
+        result = np.full(len(idx_arrs), self.MISSING, dtype=np.int64)
+        positions, found = _search_sorted(self._sorted_indices, flat_indices)
+        # Use the first atom in frame for each structure.
+        found_owners, first_found = np.unique(owners[found], return_index=True)
+        result[found_owners] = self._sorted_conformers[positions[found][first_found]]
+        return result
 
 
 def get_lines_in_frame(line_list: List[Union[Interaction, InteractionShapesLine]], complexes):
-    output = []
+    """Return lines from line_list where both structures connected by the line are in frame."""
     Logs.debug("Starting lines in frame.")
-    current_mols = [comp.current_molecule for comp in complexes if comp.current_molecule]
     start_time = time.time()
-    for line in line_list:
-        relevant_atom_indices = set(line.atom1_idx_arr + line.atom2_idx_arr)
-        atom_chain = itertools.chain(*(mol.atoms for mol in current_mols))
-        atoms_with_interactions = filter(lambda atm: atm.index in relevant_atom_indices, atom_chain)
-        line_is_in_frame = line_in_frame(line, atoms_with_interactions)
-        if line_is_in_frame:
-            output.append(line)
+    output = ConformerMap(complexes).lines_in_frame(line_list)
     end_time = time.time()
     Logs.debug(f"Finished lines in frame. Took {round(end_time - start_time, 1)} seconds.")
     return output
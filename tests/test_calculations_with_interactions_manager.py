@@ -170,6 +170,9 @@ class CalculateInteractionsTestCase(unittest.IsolatedAsyncioTestCase):
             selected_atoms_only=selected_atoms_only,
             distance_labels=distance_labels)
 
+        # Lines are read from the line manager's mirror of the workspace. Invalidate it,
+        # so the lines reported by the mocked Interaction.get are fetched again.
+        self.plugin_instance.line_manager.invalidate()
         new_line_count = len(await self.plugin_instance.line_manager.all_lines())
         self.assertTrue(new_line_count > 0)
         if distance_labels:
@@ -41,8 +41,11 @@ class CalculateInteractionsTestCase(unittest.IsolatedAsyncioTestCase):
         return super().tearDown()
 
     @patch('nanome._internal.network.PluginNetwork._instance')
-    async def test_selected_atoms(self, _):
+    @patch('nanome.api.shapes.shape.Shape.upload_multiple')
+    async def test_selected_atoms(self, upload_mock, _):
         """Validate calculate_interactions call using selected atoms."""
+        upload_mock.return_value = asyncio.Future()
+        upload_mock.return_value.set_result(None)
         target_complex = self.complex
         # Select ligand residues
         chain_name = 'HC'
@@ -90,8 +93,11 @@ class CalculateInteractionsTestCase(unittest.IsolatedAsyncioTestCase):
             distance_labels=distance_labels)
 
     @patch('nanome._internal.network.PluginNetwork._instance')
-    async def test_specific_structures(self, _):
+    @patch('nanome.api.shapes.shape.Shape.upload_multiple')
+    async def test_specific_structures(self, upload_mock, _):
         """Validate calculate_interactions call with no selections, but a list of residues provided."""
+        upload_mock.return_value = asyncio.Future()
+        upload_mock.return_value.set_result(None)
         chain_name = 'HC'
         ligand_chain = next(ch for ch in self.complex.chains if ch.name == chain_name)
 
@@ -0,0 +1,114 @@
+import copy
+import io
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+from nanome.api.structure import Complex
+from nanome.util.enums import InteractionKind
+from plugin.contacts import (
+    ContactsReader, ContactsTable, InteractingEntity, InteractionKindTable, contact_type_mask, iter_json_array,
+    parse_contact_specs)
+from plugin.forms import default_line_settings
+from plugin.models import AtomPathIndex, AtomTable
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class ContactsTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(f'{fixtures_dir}/1tyl_contacts_data.json') as f:
+            self.contacts_data = json.loads(f.read())
+        self.table = ContactsTable.from_rows(self.contacts_data)
+
+    def test_from_rows(self):
+        self.assertEqual(len(self.table), len(self.contacts_data))
+        # Atom paths are interned, so there should be fewer paths than row endpoints.
+        self.assertTrue(len(self.table.atom_paths) < len(self.contacts_data) * 2)
+        first_row = self.contacts_data[0]
+        atom1_path, atom2_path, mask = next(self.table.iter_rows())
+        self.assertEqual(atom1_path, 'C/11/O')
+        self.assertEqual(atom2_path, 'C/100/C6')
+        self.assertEqual(ContactsTable.contact_types(mask), first_row['contact'])
+        self.assertEqual(self.table.entity[0], InteractingEntity.INTER)
+
+    def test_filters(self):
+        proximal_mask = contact_type_mask(['proximal'])
+        non_proximal = self.table.contact_filter(~proximal_mask & 0xFFFFFFFF)
+        expected_count = sum(1 for row in self.contacts_data if set(row['contact']) - {'proximal'})
+        self.assertEqual(int(non_proximal.sum()), expected_count)
+
+        inter_rows = self.table.entity_filter(['INTER'])
+        expected_count = sum(1 for row in self.contacts_data if row['interacting_entities'] == 'INTER')
+        self.assertEqual(len(self.table[inter_rows]), expected_count)
+
+
+class InteractionKindTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kind_table = InteractionKindTable(default_line_settings)
+
+    def test_proximal_rejected(self):
+        # Proximal has no line settings, so it should never be accepted.
+        proximal_mask = contact_type_mask(['proximal'])
+        self.assertEqual(self.kind_table.accepted_mask & proximal_mask, 0)
+        self.assertEqual(self.kind_table.get_kinds(proximal_mask), [])
+
+    def test_get_kinds(self):
+        mask = contact_type_mask(['hbond', 'proximal', 'vdw'])
+        kinds = self.kind_table.get_kinds(mask)
+        self.assertEqual([kind for kind, _ in kinds], [InteractionKind.HydrogenBond, InteractionKind.VanDerWaals])
+        hbond_settings = kinds[0][1]
+        self.assertEqual(hbond_settings, default_line_settings['HydrogenBond'])
+
+
+class ContactsReaderTestCase(unittest.TestCase):
+
+    def test_iter_json_array(self):
+        json_str = json.dumps([{'contact': ['hbond', 'vdw]']}, 12345, -1.5e10, 0.000123, 'text', [1, 2], 7])
+        # Small read sizes make sure elements split across reads are decoded correctly,
+        # including numbers split after their '.' or 'e'.
+        for read_size in [1, 2, 3, 5, 6, 7, 64]:
+            f = io.StringIO(json_str)
+            self.assertEqual(list(iter_json_array(f.read, read_size)), json.loads(json_str))
+
+    def test_read_batches(self):
+        contacts_filepath = f'{fixtures_dir}/1tyl_contacts_data.json'
+        reader = ContactsReader(contacts_filepath, batch_size=100)
+        batch_sizes = [len(contacts_data) for contacts_data in reader]
+        self.assertEqual(batch_sizes, [100, 100, 56])
+        self.assertEqual(reader.rows_read, 256)
+        self.assertEqual(reader.estimated_row_count, 256)
+
+
+class ParseContactSpecsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        comp = Complex.io.from_pdb(path=f'{fixtures_dir}/1tyl.pdb')
+        for i, atom in enumerate(comp.atoms):
+            atom.index = 1000000000 + i
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.atom_table_path = f'{self.temp_dir.name}/atom_table.pickle'
+        with open(self.atom_table_path, 'wb') as f:
+            pickle.dump(AtomTable(AtomPathIndex([comp])), f)
+        with open(f'{fixtures_dir}/1tyl_contacts_data.json') as f:
+            self.contacts_data = json.loads(f.read())
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_skipped_rows(self):
+        missing_atom_row = copy.deepcopy(self.contacts_data[0])
+        missing_atom_row['end']['auth_atom_id'] = 'XX'
+        table = ContactsTable.from_rows([self.contacts_data[0], missing_atom_row])
+        specs, skipped_rows = parse_contact_specs(table, self.atom_table_path)
+        self.assertEqual(len(specs), 1)
+        # Rows that can't be resolved are returned, so the parent process can log them.
+        self.assertEqual(len(skipped_rows), 1)
+        atom1_path, atom2_path, mask = skipped_rows[0]
+        self.assertEqual((atom1_path, atom2_path), ('C/11/O', 'C/100/XX'))
+        self.assertEqual(ContactsTable.contact_types(mask), missing_atom_row['contact'])
@@ -5,11 +5,11 @@ import unittest
 from unittest.mock import patch
 from random import randint
 
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 from nanome.api.structure import Complex
 from nanome.api.interactions import Interaction
-from nanome.util import enums
-from plugin.managers import ShapesLineManager, InteractionLineManager
+from nanome.util import enums, Vector3
+from plugin.managers import InteractionLineManager, LabelManager, LineIndex, LineUploader, ShapesLineManager
 from plugin.models import InteractionShapesLine, InteractionStructure
 from plugin.forms import default_line_settings
 from nanome._internal.network import PluginNetwork
@@ -116,6 +116,101 @@ class ShapesLineManagerTestCase(unittest.IsolatedAsyncioTestCase):
             self.struct2, self.struct3)
         self.assertEqual(len(structpair_lines_2_3), 0)
 
+    @patch('nanome.api.shapes.shape.Shape.destroy_multiple')
+    async def test_update_interaction_lines_color_streams(self, destroy_mock):
+        plugin = MagicMock()
+        plugin.create_writing_stream = AsyncMock(side_effect=lambda *args: (MagicMock(), None))
+        interactions_data = {
+            kind.name: {'visible': True, 'color': (255, 0, 0)}
+            for kind in [enums.InteractionKind.Covalent, enums.InteractionKind.Aromatic]
+        }
+        self.interaction_line._index = 1
+        self.interaction_line_2._index = 2
+        self.manager.add_line(self.interaction_line)
+        await self.manager.update_interaction_lines(interactions_data, [self.complex], plugin)
+        self.assertEqual(plugin.create_writing_stream.call_count, 1)
+        stream1 = self.manager._color_streams[0].stream
+        stream1.update.assert_called_once_with([255, 0, 0, 255])
+
+        # New lines get their own stream, and unchanged streams aren't updated again.
+        self.manager.add_line(self.interaction_line_2)
+        await self.manager.update_interaction_lines(interactions_data, [self.complex], plugin)
+        self.assertEqual(plugin.create_writing_stream.call_count, 2)
+        stream1.update.assert_called_once()
+        stream1.destroy.assert_not_called()
+
+        # Deleting a line destroys its stream.
+        self.manager.destroy_lines([self.interaction_line])
+        stream1.destroy.assert_called_once()
+        self.assertEqual(len(self.manager._color_streams), 1)
+
+    async def test_update_interaction_lines_for_kind(self):
+        plugin = MagicMock()
+        plugin.create_writing_stream = AsyncMock(side_effect=lambda *args: (MagicMock(), None))
+        interactions_data = {
+            kind.name: {'visible': True, 'color': (255, 0, 0)}
+            for kind in [enums.InteractionKind.Covalent, enums.InteractionKind.Aromatic]
+        }
+        self.interaction_line._index = 1
+        self.interaction_line_2._index = 2
+        self.manager.add_lines([self.interaction_line, self.interaction_line_2])
+        await self.manager.update_interaction_lines(interactions_data, [self.complex], plugin)
+        self.assertEqual(
+            self.manager.get_lines_for_kind(enums.InteractionKind.Aromatic), [self.interaction_line_2])
+
+        interactions_data['Covalent']['visible'] = False
+        interactions_data['Aromatic']['visible'] = False
+        kinds = [enums.InteractionKind.Aromatic]
+        await self.manager.update_interaction_lines(interactions_data, [self.complex], plugin, kinds=kinds)
+        # Only lines of the toggled kind are updated.
+        self.assertEqual(self.interaction_line.color.a, 255)
+        self.assertEqual(self.interaction_line_2.color.a, 0)
+
+    @patch('nanome.api.shapes.shape.Shape.destroy_multiple')
+    async def test_destroy_lines_between_same_structures(self, destroy_mock):
+        kinds = [enums.InteractionKind.Covalent, enums.InteractionKind.HydrogenBond, enums.InteractionKind.Ionic]
+        lines = [InteractionShapesLine(self.struct1, self.struct2, kind=kind) for kind in kinds]
+        self.manager.add_lines(lines)
+        # Lines with a kind that's already drawn between the structures are ignored.
+        self.manager.add_line(InteractionShapesLine(self.struct1, self.struct2, kind=kinds[0]))
+        self.assertEqual(len(await self.manager.all_lines()), 3)
+
+        self.manager.destroy_lines(lines[:1])
+        remaining_lines = self.manager.get_lines_for_structure_pair(self.struct1, self.struct2)
+        self.assertCountEqual(remaining_lines, lines[1:])
+        # Remaining lines can still be destroyed after being moved.
+        self.manager.destroy_lines([lines[2]])
+        self.assertEqual(await self.manager.all_lines(), [lines[1]])
+        # Kind of destroyed line can be drawn again.
+        self.manager.add_line(lines[0])
+        self.assertCountEqual(await self.manager.all_lines(), lines[:2])
+
+    def test_structure_index(self):
+        ring_atoms = list(self.complex.atoms)[2:7]
+        expected_index = tuple(sorted(a.index for a in ring_atoms))
+        self.assertEqual(self.struct3.index, expected_index)
+        self.assertEqual(self.struct3.line_anchor.index, expected_index[0])
+        self.assertEqual(self.struct1.index, (self.struct1.atoms[0].index,))
+        # Ring anchor is offset to the center of the ring
+        offset = self.struct3.calculate_local_offset()
+        anchor_position = self.struct3.line_anchor.position
+        self.assertAlmostEqual(anchor_position.x + offset.x, self.struct3.centroid.x, places=4)
+
+    def test_line_conformations(self):
+        # Index of atom2 contains index of atom1, which shouldn't affect conformer lookup.
+        atom1, atom2 = list(self.complex.atoms)[:2]
+        atom1.index = 1234
+        atom2.index = 123456
+        struct1 = InteractionStructure(atom1)
+        struct2 = InteractionStructure(atom2)
+        struct1.conformer = 1
+        struct2.conformer = 2
+        line = InteractionShapesLine(struct1, struct2, kind=enums.InteractionKind.Covalent)
+        self.assertEqual(line.atom1_conformation, 1)
+        self.assertEqual(line.atom2_conformation, 2)
+        self.assertEqual(line.structure_indices, ((1234,), (123456,)))
+        self.assertAlmostEqual(line.length, Vector3.distance(atom1.position, atom2.position), places=4)
+
 
 class InteractionLineManagerTestCase(unittest.IsolatedAsyncioTestCase):
 
@@ -160,13 +255,132 @@ class InteractionLineManagerTestCase(unittest.IsolatedAsyncioTestCase):
         self.get_fut_2_lines.set_result([self.interaction_line, self.interaction_line_2])
 
     async def test_add_line(self):
-        # This function doesn't do anything, but it needs to exist on the manager to match interface.
+        # Adds line to the local mirror, and needs to exist on the manager to match interface.
         assert getattr(self.manager, 'add_line')
 
     async def test_add_lines(self):
-        # This function doesn't do anything, but it needs to exist on the manager to match interface.
+        # Adds lines to the local mirror, and needs to exist on the manager to match interface.
         assert getattr(self.manager, 'add_lines')
 
+    @patch('nanome.api.interactions.interaction.Interaction.destroy_multiple')
+    @patch('nanome.api.interactions.interaction.Interaction.get')
+    async def test_all_lines_mirror(self, get_mock, destroy_mock):
+        self.interaction_line.index = 1
+        get_mock.return_value = self.get_fut_1_line
+        mol_index = self.complex.current_molecule.index
+        lines = await self.manager.all_lines(molecules_idx=[mol_index])
+        self.assertEqual(lines, [self.interaction_line])
+        # Lines we upload are added to the mirror, so the workspace isn't fetched again.
+        self.manager.add_lines([self.interaction_line_2], [self.complex])
+        lines = await self.manager.all_lines(molecules_idx=[mol_index])
+        self.assertEqual(lines, [self.interaction_line, self.interaction_line_2])
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertEqual(
+            self.manager.mirror.get_lines_for_kind(enums.InteractionKind.Aromatic), [self.interaction_line_2])
+
+        self.manager.destroy_lines([self.interaction_line])
+        lines = await self.manager.all_lines(molecules_idx=[mol_index])
+        self.assertEqual(lines, [self.interaction_line_2])
+        self.assertEqual(self.manager.mirror.get_lines_for_atom(self.interaction_line.atom2_idx_arr[0]), [])
+
+        # Invalidated mirror fetches lines again.
+        self.manager.invalidate()
+        await self.manager.all_lines(molecules_idx=[mol_index])
+        self.assertEqual(get_mock.call_count, 2)
+
+    @patch('nanome.api.interactions.interaction.Interaction.upload_multiple')
+    @patch('nanome.api.interactions.interaction.Interaction.get')
+    async def test_uploaded_lines_mirrored_after_acknowledgement(self, get_mock, upload_mock):
+        get_mock.return_value = self.get_fut_empty
+        upload_fut = asyncio.get_event_loop().create_future()
+        upload_mock.return_value = upload_fut
+        mol_index = self.complex.current_molecule.index
+        await self.manager.all_lines(molecules_idx=[mol_index])
+        uploader = LineUploader(self.manager, chunk_size=1, complexes=[self.complex])
+        await uploader.add([self.interaction_line])
+        # Line has no index until Nanome acknowledges the upload, so it isn't mirrored yet.
+        self.assertEqual(await self.manager.all_lines(molecules_idx=[mol_index]), [])
+
+        self.interaction_line.index = 5
+        upload_fut.set_result(None)
+        await uploader.flush()
+        self.assertEqual(await self.manager.all_lines(molecules_idx=[mol_index]), [self.interaction_line])
+        # Fetching the same workspace interaction again matches our copy instead of duplicating it.
+        fetched_line = Interaction(
+            kind=self.interaction_line.kind,
+            atom1_idx_arr=self.interaction_line.atom1_idx_arr,
+            atom2_idx_arr=self.interaction_line.atom2_idx_arr,
+            atom1_conf=0,
+            atom2_conf=0
+        )
+        fetched_line.index = 5
+        get_fut = asyncio.Future()
+        get_fut.set_result([fetched_line])
+        get_mock.return_value = get_fut
+        self.assertEqual(await self.manager.all_lines(), [self.interaction_line])
+
+    @patch('nanome.api.interactions.interaction.Interaction.upload_multiple')
+    @patch('nanome.api.interactions.interaction.Interaction.get')
+    async def test_update_interaction_lines_for_kind(self, get_mock, upload_mock):
+        self.interaction_line.index = 1
+        self.interaction_line_2.index = 2
+        get_mock.return_value = self.get_fut_2_lines
+        interactions_data = {
+            kind.name: {'visible': False}
+            for kind in [enums.InteractionKind.Covalent, enums.InteractionKind.Aromatic]
+        }
+        kinds = [enums.InteractionKind.Aromatic]
+        await self.manager.update_interaction_lines(interactions_data, [self.complex], kinds=kinds)
+        # Only lines of the toggled kind are updated.
+        upload_mock.assert_called_once_with([self.interaction_line_2])
+        self.assertTrue(self.interaction_line.visible)
+
+    @patch('nanome.api.interactions.interaction.Interaction.get')
+    async def test_get_lines_for_kind_unfetched_molecule(self, get_mock):
+        get_mock.return_value = self.get_fut_1_line
+        mol_index = self.complex.current_molecule.index
+        kind = self.interaction_line.kind
+        self.assertEqual(self.manager.mirror.get_lines_for_kind(kind, [mol_index]), [])
+        # Looking up lines by kind doesn't mark the molecule as fetched.
+        await self.manager.all_lines(molecules_idx=[mol_index])
+        get_mock.assert_called_once()
+        self.assertEqual(self.manager.mirror.get_lines_for_kind(kind, [mol_index]), [self.interaction_line])
+
+    @patch('nanome.api.interactions.interaction.Interaction.upload_multiple')
+    def test_update_visibility(self, upload_mock):
+        line_settings = {
+            'Covalent': {'visible': True},
+            'Aromatic': {'visible': False},
+        }
+        lines = [self.interaction_line, self.interaction_line_2]
+        changed_lines = self.manager.update_visibility(lines, line_settings)
+        self.assertEqual(changed_lines, [self.interaction_line_2])
+        self.assertFalse(self.interaction_line_2.visible)
+        upload_mock.assert_called_once_with([self.interaction_line_2])
+
+    def test_line_index_matches(self):
+        line_index = LineIndex([self.interaction_line, self.interaction_line_2])
+        kind = self.interaction_line.kind
+        # Key is the same regardless of which structure is first.
+        self.assertTrue(line_index.match(LineIndex.get_structpair_key(self.struct2, self.struct1, kind)))
+        self.assertFalse(line_index.match(LineIndex.get_structpair_key(self.struct2, self.struct3, kind)))
+        self.assertEqual(line_index.matched_lines(), [self.interaction_line])
+        self.assertEqual(line_index.unmatched_lines(), [self.interaction_line_2])
+
+    def test_line_index_duplicates(self):
+        duplicate_line = Interaction(
+            kind=self.interaction_line.kind,
+            atom1_idx_arr=self.interaction_line.atom2_idx_arr,
+            atom2_idx_arr=self.interaction_line.atom1_idx_arr,
+            atom1_conf=0,
+            atom2_conf=0
+        )
+        line_index = LineIndex([self.interaction_line, duplicate_line, self.interaction_line_2])
+        self.assertTrue(line_index.match(LineIndex.get_structpair_key(self.struct1, self.struct2, duplicate_line.kind)))
+        # Only the first copy is kept, the duplicate is listed to be destroyed.
+        self.assertEqual(line_index.matched_lines(), [self.interaction_line])
+        self.assertEqual(line_index.unmatched_lines(), [duplicate_line, self.interaction_line_2])
+
     @patch('nanome.api.interactions.interaction.Interaction.upload_multiple')
     def test_upload(self, upload_mock):
         line_list = [self.interaction_line, self.interaction_line_2]
@@ -199,3 +413,111 @@ class InteractionLineManagerTestCase(unittest.IsolatedAsyncioTestCase):
         structpair_lines_2_3 = self.manager.get_lines_for_structure_pair(
             self.struct2, self.struct3, existing_lines=lines)
         self.assertEqual(len(structpair_lines_2_3), 0)
+
+
+class LabelManagerTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        nanome.PluginInstance._instance = MagicMock()
+        self.manager = LabelManager()
+
+    @patch('nanome.api.shapes.shape.Shape.destroy_multiple')
+    @patch('nanome.api.shapes.shape.Shape.upload_multiple', new_callable=AsyncMock)
+    async def test_reconcile(self, upload_mock, destroy_mock):
+        added, removed, updated = await self.manager.reconcile([(1, 2, '3.1'), (3, 4, '2.5')])
+        self.assertEqual(len(added), 2)
+        upload_mock.assert_called_with(added)
+        label_3_4 = self.manager._data[self.manager.get_structpair_key(3, 4)]
+
+        # Only changed labels should be sent to Nanome.
+        upload_mock.reset_mock()
+        added, removed, updated = await self.manager.reconcile([(2, 1, '3.1'), (3, 4, '2.6'), (5, 6, '4.0')])
+        self.assertEqual([label.text for label in added], ['4.0'])
+        self.assertEqual(removed, [])
+        self.assertEqual(updated, [label_3_4])
+        self.assertEqual(label_3_4.text, '2.6')
+        upload_mock.assert_called_once_with(added + updated)
+
+        upload_mock.reset_mock()
+        added, removed, updated = await self.manager.reconcile([(5, 6, '4.0')])
+        self.assertEqual(len(removed), 2)
+        destroy_mock.assert_called_with(removed)
+        upload_mock.assert_not_called()
+        self.assertEqual(len(self.manager.all_labels()), 1)
+
+    def test_structpair_key(self):
+        key = self.manager.get_structpair_key(5, (3, 1))
+        self.assertEqual(key, ((1, 3), (5,)))
+        self.assertEqual(self.manager.get_structpair_key((1, 3), 5), key)
+        # Labels are listed in the order they were added, rather than by key.
+        label_1 = self.manager.create_label(9, 10, '1.0')
+        label_2 = self.manager.create_label(1, 2, '2.0')
+        self.manager.add_label(label_1, 9, 10)
+        self.manager.add_label(label_2, 1, 2)
+        self.assertEqual(self.manager.all_labels(), [label_1, label_2])
+
+
+class LineUploaderTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.line_manager = MagicMock()
+        self.upload_futures = []
+        # Number of unacknowledged uploads, including the new one, at each upload call.
+        self.uploads_in_flight = []
+
+        def upload(line_list):
+            fut = asyncio.get_event_loop().create_future()
+            self.upload_futures.append(fut)
+            self.uploads_in_flight.append(sum(1 for f in self.upload_futures if not f.done()))
+            return fut
+        self.line_manager.upload.side_effect = upload
+
+    async def acknowledge_uploads(self, task):
+        """Acknowledge every upload sent until task completes."""
+        while not task.done():
+            for fut in self.upload_futures:
+                if not fut.done():
+                    fut.set_result(None)
+            await asyncio.sleep(0)
+        await task
+
+    async def test_chunked_upload(self):
+        progress = MagicMock()
+        uploader = LineUploader(self.line_manager, chunk_size=3, max_pending_uploads=4, progress=progress)
+        await uploader.add(list(range(7)))
+        # Full chunks are sent immediately, remaining lines wait for the next chunk or flush.
+        uploaded_chunks = [call.args[0] for call in self.line_manager.upload.call_args_list]
+        self.assertEqual(uploaded_chunks, [[0, 1, 2], [3, 4, 5]])
+        # Chunks are only added to the line manager once acknowledged.
+        self.line_manager.add_lines.assert_not_called()
+        progress.advance.assert_not_called()
+
+        await self.acknowledge_uploads(asyncio.create_task(uploader.flush()))
+        self.line_manager.upload.assert_called_with([6])
+        added_chunks = [call.args[0] for call in self.line_manager.add_lines.call_args_list]
+        self.assertEqual(added_chunks, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(uploader.uploaded_lines, list(range(7)))
+        uploaded_count = sum(call.args[1] for call in progress.advance.call_args_list)
+        self.assertEqual(uploaded_count, 7)
+
+    async def test_max_pending_uploads(self):
+        uploader = LineUploader(self.line_manager, chunk_size=1, max_pending_uploads=2)
+        add_task = asyncio.create_task(uploader.add(list(range(5))))
+        await asyncio.sleep(0)
+        # Third chunk waits for the first to be acknowledged before it's sent.
+        self.assertEqual(self.line_manager.upload.call_count, 2)
+        self.assertFalse(add_task.done())
+        self.upload_futures[0].set_result(None)
+        await asyncio.sleep(0)
+        self.assertEqual(self.line_manager.upload.call_count, 3)
+        await self.acknowledge_uploads(add_task)
+        self.assertEqual(self.line_manager.upload.call_count, 5)
+
+    async def test_uploads_in_flight_bounded(self):
+        max_pending_uploads = 3
+        uploader = LineUploader(self.line_manager, chunk_size=2, max_pending_uploads=max_pending_uploads)
+        add_task = asyncio.create_task(uploader.add(list(range(20))))
+        await self.acknowledge_uploads(add_task)
+        await self.acknowledge_uploads(asyncio.create_task(uploader.flush()))
+        self.assertEqual(self.line_manager.upload.call_count, 10)
+        self.assertEqual(max(self.uploads_in_flight), max_pending_uploads)
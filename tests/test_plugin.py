@@ -1,14 +1,20 @@
 import asyncio
+import filecmp
 import itertools
 import json
 import os
+import shutil
+import tempfile
 import unittest
 from random import randint
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from nanome.api.structure import Atom, Complex
 from plugin.ChemicalInteractions import ChemicalInteractions
-from plugin.forms import default_line_settings
+from plugin.clean_pdb import CleanedPdbCache, clean_complex, clean_pdb, get_complex_fingerprints
+from plugin.forms import LineSettingsForm, default_line_settings
+from plugin.contacts import ContactsTable, InteractionKindTable
+from plugin.models import AtomPathIndex
 
 
 fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -38,6 +44,68 @@ class PluginFunctionTestCase(unittest.IsolatedAsyncioTestCase):
         cleaned_complex = Complex.io.from_pdb(path=result)
         self.assertTrue(sum(1 for _ in cleaned_complex.atoms) > 0)
 
+    def test_clean_pdb(self):
+        # Cleaned file should match the known output for 1tyl.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdb_path = shutil.copy(f'{fixtures_dir}/1tyl.pdb', temp_dir)
+            cleaned_filepath = clean_pdb(pdb_path)
+            self.assertTrue(filecmp.cmp(cleaned_filepath, f'{fixtures_dir}/1tyl_cleaned.pdb', shallow=False))
+
+    def test_clean_pdb_small_batches(self):
+        # Batches cleaned in parallel are still written in order.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdb_path = shutil.copy(f'{fixtures_dir}/1tyl.pdb', temp_dir)
+            with patch('plugin.clean_pdb.RESIDUE_BATCH_SIZE', 7):
+                cleaned_filepath = clean_pdb(pdb_path)
+            self.assertTrue(filecmp.cmp(cleaned_filepath, f'{fixtures_dir}/1tyl_cleaned.pdb', shallow=False))
+
+    def test_clean_complex(self):
+        # Cleaning the Complex directly should match cleaning the pdb file written from it.
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdb_path = f'{temp_dir}/1tyl.pdb'
+            self.complex.io.to_pdb(pdb_path)
+            for keep_hydrogens in [True, False]:
+                cleaned_filepath = clean_pdb(pdb_path, keep_hydrogens=keep_hydrogens)
+                cleaned_complex_filepath = clean_complex(
+                    self.complex, f'{temp_dir}/1tyl_complex.pdb', keep_hydrogens=keep_hydrogens)
+                self.assertTrue(filecmp.cmp(cleaned_filepath, cleaned_complex_filepath, shallow=False))
+
+    def test_cleaned_pdb_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = CleanedPdbCache(temp_dir, max_entries=1)
+            cleaned_filepath = cache.clean_complex(self.complex)
+            # Unchanged complex reuses the cleaned file.
+            mtime = os.path.getmtime(cleaned_filepath)
+            self.assertEqual(cache.clean_complex(self.complex), cleaned_filepath)
+            self.assertEqual(os.path.getmtime(cleaned_filepath), mtime)
+            # Cleaning flags are part of the key.
+            dry_filepath = cache.clean_complex(self.complex, remove_waters=True)
+            self.assertNotEqual(dry_filepath, cleaned_filepath)
+            # Least recently used file is evicted.
+            self.assertEqual(len(cache), 1)
+            self.assertFalse(os.path.exists(cleaned_filepath))
+            atom = next(self.complex.atoms)
+            atom.position.x += 1
+            self.assertNotEqual(cache.clean_complex(self.complex, remove_waters=True), dry_filepath)
+
+    def test_cleaned_pdb_cache_topology(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = CleanedPdbCache(temp_dir)
+            cache.clean_complex(self.complex)
+            topology_fingerprint, _, _ = get_complex_fingerprints(self.complex)
+            topology = cache.get_topology(topology_fingerprint)
+            # Moving atoms only rewrites coordinates, using the cached topology.
+            residue = list(self.complex.residues)[5]
+            for atom in residue.atoms:
+                atom.position.x += 30
+            moved_topology_fingerprint, _, _ = get_complex_fingerprints(self.complex)
+            self.assertEqual(moved_topology_fingerprint, topology_fingerprint)
+            cleaned_filepath = cache.clean_complex(self.complex)
+            self.assertIs(cache.get_topology(topology_fingerprint), topology)
+            # Output still matches a full clean, including the broken peptide bonds.
+            expected_filepath = clean_complex(self.complex, f'{temp_dir}/1tyl_expected.pdb')
+            self.assertTrue(filecmp.cmp(cleaned_filepath, expected_filepath, shallow=False))
+
     def test_get_atom_path(self):
         # I think the first atom is always consistent?
         atom = next(self.complex.atoms)
@@ -65,6 +133,22 @@ class PluginFunctionTestCase(unittest.IsolatedAsyncioTestCase):
         atom = self.plugin_instance.get_atom_from_path(self.complex, atom_path)
         self.assertTrue(isinstance(atom, Atom))
 
+    def test_atom_path_index_heteroatom_chain(self):
+        # Ligand atoms are stored on chain 'HC', but arpeggio refers to chain 'C'
+        atom_index = AtomPathIndex([self.complex])
+        atom = atom_index.get_atom("C/100/C1")
+        self.assertTrue(isinstance(atom, Atom))
+        self.assertEqual(atom.chain.name, 'HC')
+        self.assertIsNone(atom_index.get_atom("C/100/XX"))
+
+    def test_atom_path_index_owners(self):
+        atom_index = AtomPathIndex([self.complex])
+        atom = next(self.complex.atoms)
+        comp, frame, conformer = atom_index.atom_owners[atom.index]
+        self.assertEqual(comp, self.complex)
+        self.assertEqual(frame, self.complex.current_frame)
+        self.assertEqual(conformer, self.complex.current_conformer)
+
     def test_get_interaction_selections_residues(self):
         # Select all atoms in 10 residues
         residue_count = 10
@@ -103,6 +187,17 @@ class PluginFunctionTestCase(unittest.IsolatedAsyncioTestCase):
         )
         self.assertEqual(len(line_list), expected_line_count)
 
+    def test_parse_contacts_data_existing_lines(self):
+        with open(f'{fixtures_dir}/1tyl_contacts_data.json') as f:
+            contacts_data = json.loads(f.read())
+        line_list = self.plugin_instance.parse_contacts_data(
+            contacts_data, [self.complex], default_line_settings)
+        # Lines that already exist should not be drawn again.
+        existing_lines = line_list[:10]
+        new_line_list = self.plugin_instance.parse_contacts_data(
+            contacts_data, [self.complex], default_line_settings, existing_lines=existing_lines)
+        self.assertEqual(len(new_line_list), len(line_list) - len(existing_lines))
+
     def test_run_arpeggio(self):
         with open(f'{fixtures_dir}/1tyl_ligand_selections.json') as f:
             arpeggio_data = json.loads(f.read())
@@ -111,3 +206,22 @@ class PluginFunctionTestCase(unittest.IsolatedAsyncioTestCase):
         contacts_data = {}
         contacts_data = loop.run_until_complete(self.plugin_instance.run_arpeggio_process(arpeggio_data, cleaned_pdb))
         self.assertTrue(contacts_data)
+
+    def test_iter_lines_in_processes(self):
+        with open(f'{fixtures_dir}/1tyl_contacts_data.json') as f:
+            contacts_data = ContactsTable.from_rows(json.loads(f.read()))
+        # Should produce the same lines as the threaded parser.
+        expected_line_count = 26
+        atom_index = AtomPathIndex([self.complex])
+        kind_table = InteractionKindTable(LineSettingsForm(data=default_line_settings).data)
+        executors = []
+        for _ in range(2):
+            line_chunks = self.plugin_instance.iter_lines_in_processes(
+                contacts_data, False, ['INTER', 'INTRA_SELECTION', 'SELECTION_WATER'], [],
+                atom_index, kind_table, process_count=2)
+            line_list = list(itertools.chain.from_iterable(line_chunks))
+            self.assertEqual(len(line_list), expected_line_count)
+            executors.append(self.plugin_instance.parse_executor)
+        # Worker processes are reused across runs, and each run's AtomTable file is removed.
+        self.assertIs(executors[0], executors[1])
+        self.assertFalse(os.listdir(self.plugin_instance.temp_dir.name))
@@ -0,0 +1,91 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+from nanome.api.interactions import Interaction
+from nanome.api.structure import Complex
+from nanome.util import enums, Vector3
+from plugin.utils import ProgressTracker, calculate_interaction_lengths, centroid, get_lines_in_frame
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class ProgressTrackerTestCase(unittest.TestCase):
+
+    def test_weighted_fraction(self):
+        progress = ProgressTracker(MagicMock(), {'clean': 1, 'parse': 3})
+        progress.set_total('clean', 10)
+        progress.set_total('parse', 100)
+        progress.complete('clean')
+        self.assertAlmostEqual(progress.fraction, 0.25)
+        progress.advance('parse', 50)
+        self.assertAlmostEqual(progress.fraction, 0.625)
+        # Stages without a weight don't affect the loading bar.
+        progress.advance('other', 5)
+        self.assertAlmostEqual(progress.fraction, 0.625)
+
+    def test_threaded_updates_throttled(self):
+        update_fn = MagicMock()
+        progress = ProgressTracker(update_fn, {'parse': 1}, max_updates_per_second=1)
+        progress.set_total('parse', 4000)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in range(4):
+                executor.submit(lambda: [progress.advance('parse') for _ in range(1000)])
+        self.assertEqual(progress.stage_counts['parse'], 4000)
+        self.assertEqual(progress.fraction, 1.0)
+        # Only the first update should have been sent within the interval.
+        self.assertEqual(update_fn.call_count, 1)
+
+    def test_complete_not_throttled(self):
+        update_fn = MagicMock()
+        progress = ProgressTracker(update_fn, {'parse': 1}, max_updates_per_second=1)
+        progress.set_total('parse', 10)
+        progress.advance('parse', 5)
+        # The advance is throttled, only the set_total update was sent.
+        update_fn.assert_called_once()
+        # Final update is sent even within the throttle interval.
+        progress.complete('parse')
+        self.assertEqual(update_fn.call_count, 2)
+        update_fn.assert_called_with(1.0, 1)
+
+
+class LinesInFrameTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.complex = Complex.io.from_pdb(path=f'{fixtures_dir}/1tyl.pdb')
+        for i, atom in enumerate(self.complex.atoms):
+            atom.index = 1000000000 + i
+
+    def test_get_lines_in_frame(self):
+        atoms = list(self.complex.atoms)
+        conformer = self.complex.current_molecule.current_conformer
+        ring_indices = [atm.index for atm in atoms[2:7]]
+        in_frame_line = Interaction(
+            enums.InteractionKind.Aromatic, [atoms[0].index], ring_indices,
+            atom1_conf=conformer, atom2_conf=conformer)
+        wrong_conformer_line = Interaction(
+            enums.InteractionKind.Covalent, [atoms[0].index], [atoms[1].index],
+            atom1_conf=conformer, atom2_conf=conformer + 1)
+        missing_atom_line = Interaction(
+            enums.InteractionKind.Covalent, [atoms[0].index], [1],
+            atom1_conf=conformer, atom2_conf=conformer)
+        lines = [in_frame_line, wrong_conformer_line, missing_atom_line]
+        self.assertEqual(get_lines_in_frame(lines, [self.complex]), [in_frame_line])
+        self.assertEqual(get_lines_in_frame([], [self.complex]), [])
+
+    def test_calculate_interaction_lengths(self):
+        atoms = list(self.complex.atoms)
+        ring_atoms = atoms[2:7]
+        lines = [
+            Interaction(enums.InteractionKind.Covalent, [atoms[0].index], [atoms[1].index]),
+            Interaction(enums.InteractionKind.Aromatic, [atoms[0].index], [atm.index for atm in ring_atoms]),
+        ]
+        expected_distances = [
+            Vector3.distance(atoms[0].position, atoms[1].position),
+            Vector3.distance(atoms[0].position, centroid(ring_atoms)),
+        ]
+        distances = calculate_interaction_lengths(lines, [self.complex])
+        for distance, expected_distance in zip(distances, expected_distances):
+            self.assertAlmostEqual(distance, expected_distance)